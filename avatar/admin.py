@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import time
+from multiprocessing.pool import ThreadPool
+
+from trac.core import *
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.util.text import exception_to_unicode, print_table, printout
+from trac.web.api import IRequestHandler
+
+from backend import avatar_slug
+from executor import RenderUnavailable
+from image import get_cache_stats
+from metrics import AvatarMetrics
+from web_ui import AvatarModule, AvatarProvider
+
+class AvatarAdmin(Component):
+    """
+    trac-admin commands to warm up and maintain the avatar caches, and
+    the statistics of the caches and metrics as JSON under
+    `/avatar-stats` for TRAC_ADMIN.
+    """
+
+    implements(IAdminCommandProvider, IRequestHandler)
+
+    def get_stats(self):
+        """Return the statistics of the caches and the recorded metrics
+        of this process."""
+        module = AvatarModule(self.env)
+        stats = {
+            'metrics': AvatarMetrics(self.env).snapshot(),
+            'author cache': module.backend.author_cache.stats(),
+        }
+        for name, cache_stats in get_cache_stats().iteritems():
+            stats['{} cache'.format(name)] = cache_stats
+        if self.env.is_component_enabled(AvatarProvider):
+            provider = AvatarProvider(self.env)
+            for name, cache in (('render cache', provider.render_cache),
+                                ('sprite cache', provider.sprite_cache)):
+                count, total = cache.usage()
+                stats[name] = {
+                    'entries': count,
+                    'bytes': total,
+                    'max_bytes': provider.cache_size,
+                }
+            stats.update({
+                'hash index': {'keys': len(provider._hash_index)},
+                'renders': provider.renders.stats(),
+                'executor': provider.executor.stats(),
+            })
+        return stats
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info == '/avatar-stats'
+
+    def process_request(self, req):
+        req.perm.require('TRAC_ADMIN')
+        req.send(json.dumps(self.get_stats(), indent=2, sort_keys=True),
+                 'application/json')
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('avatar warm', '[--sizes <size,...>] [--jobs <n>]',
+               """Render the avatar of every user in advance
+
+               By default every size configured in the [avatar] section is
+               rendered, with the high density variants.
+               """,
+               None, self._do_warm)
+        yield ('avatar stats', '',
+               'Show the usage of the avatar caches and the metrics',
+               None, self._do_stats)
+        yield ('avatar purge', '',
+               'Remove every cached avatar and sprite sheet',
+               None, self._do_purge)
+        yield ('avatar rebuild-index', '',
+               'Rebuild the index of avatar hashes',
+               None, self._do_rebuild_index)
+
+    def _do_warm(self, *args):
+        provider = self._get_provider()
+        sizes = provider.get_avatar_sizes()
+        jobs = provider.render_workers
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in ('--sizes', '--jobs') and not args:
+                raise AdminCommandError('{} requires a value'.format(arg))
+            if arg == '--sizes':
+                try:
+                    sizes = sorted(set(int(s) for s in
+                                       args.pop(0).replace(',', ' ').split()))
+                except ValueError:
+                    raise AdminCommandError('Invalid sizes')
+            elif arg == '--jobs':
+                try:
+                    jobs = int(args.pop(0))
+                except ValueError:
+                    raise AdminCommandError('Invalid number of jobs')
+            else:
+                raise AdminCommandError('Unknown argument "{}"'.format(arg))
+        if not sizes or min(sizes) <= 0 or jobs <= 0:
+            raise AdminCommandError('Sizes and jobs must be positive')
+
+        hashes = set(avatar_slug(email) for email, in self.env.db_query("""
+                SELECT value FROM session_attribute
+                WHERE authenticated=1 AND name='email' AND value!=''
+                """))
+        formats = ['png'] + provider.output_formats
+        tasks = [(h, size, fmt) for h in sorted(hashes)
+                                for size in sizes for fmt in formats]
+
+        def warm(task):
+            email_hash, size, fmt = task
+            try:
+                provider.get_avatar(email_hash, size, fmt)
+            except RenderUnavailable:
+                return 'overloaded'
+            except Exception, e:
+                self.log.warning('Failed to render avatar %s (%s, %s): %s',
+                                 email_hash, size, fmt,
+                                 exception_to_unicode(e, traceback=True))
+                return 'error'
+            return None
+
+        start = time.time()
+        pool = ThreadPool(min(jobs, len(tasks) or 1))
+        try:
+            results = pool.map(warm, tasks)
+        finally:
+            pool.close()
+            pool.join()
+            provider.executor.close()
+        overloaded = results.count('overloaded')
+        errors = results.count('error')
+        printout('Rendered {} avatars of {} users in {:.1f}s'.format(
+                 len(tasks) - overloaded - errors, len(hashes),
+                 time.time() - start))
+        if overloaded:
+            printout('{} renders failed, the render pool is overloaded; '
+                     'retry with fewer --jobs'.format(overloaded))
+        if errors:
+            printout('{} renders failed with an error, see the log for '
+                     'details'.format(errors))
+
+    def _do_stats(self):
+        rows = []
+
+        def flatten(section, prefix, stats):
+            for key in sorted(stats):
+                value = stats[key]
+                if isinstance(value, dict):
+                    flatten(section, prefix + key + '.', value)
+                    continue
+                if isinstance(value, float):
+                    value = '{:.3f}'.format(value)
+                rows.append((section, prefix + key, value))
+
+        for section, stats in sorted(self.get_stats().iteritems()):
+            flatten(section, '', stats)
+        print_table(rows, ['Section', 'Statistic', 'Value'])
+        printout('In-memory caches and metrics are per process, the values '
+                 'above only cover this trac-admin process.  See '
+                 '/avatar-stats for those of the web server.')
+
+    def _do_purge(self):
+        provider = self._get_provider()
+        count, total = provider.render_cache.usage()
+        provider.render_cache.purge()
+        printout('Removed {} cached avatars ({} bytes)'.format(count, total))
+        count, total = provider.sprite_cache.usage()
+        provider.sprite_cache.purge()
+        printout('Removed {} sprite sheets ({} bytes)'.format(count, total))
+
+    def _do_rebuild_index(self):
+        provider = self._get_provider()
+        provider.invalidate_index()
+        printout('Indexed {} avatar keys'.format(len(provider._hash_index)))
+
+    def _get_provider(self):
+        if not self.env.is_component_enabled(AvatarProvider):
+            raise AdminCommandError('The built-in avatar provider '
+                                    '(avatar.web_ui.AvatarProvider) is '
+                                    'disabled')
+        return AvatarProvider(self.env)
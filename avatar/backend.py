@@ -30,13 +30,26 @@
 import os
 import sys
 import re
+import base64
 import hashlib
 import itertools
+import threading
 
 from trac.core import *
-from trac.config import Option
+from trac.config import BoolOption, IntOption, Option
+from trac.util.text import unicode_urlencode
 from genshi.builder import tag
 
+from cache import LRUCache
+from metrics import AvatarMetrics
+
+def avatar_slug(email):
+    if email is None:
+        email = ''
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return hashlib.md5(email.lower()).hexdigest()
+
 class AvatarBackend():
     
     default = Option('avatar', 'avatar_default', default='default',
@@ -49,6 +62,36 @@ class AvatarBackend():
     custom_backend = Option('avatar', 'custom_backend', default='',
                             doc="The URL of the avator service to use as a "
                                 "custom backend.")
+    proxy = BoolOption('avatar', 'proxy', default='false',
+                       doc="Serve gravatar and libravatar avatars from this "
+                           "site.  They are fetched and cached by the "
+                           "built-in avatar handler, so browsers never "
+                           "contact the external service.")
+    author_cache_size = IntOption('avatar', 'author_cache_size',
+                                  default=10000,
+                                  doc="Number of authors whose avatar hash "
+                                      "is remembered across requests.")
+    author_cache_ttl = IntOption('avatar', 'author_cache_ttl', default=300,
+                                 doc="Number of seconds an author's avatar "
+                                     "hash is remembered.")
+    lookup_chunk_size = IntOption('avatar', 'lookup_chunk_size', default=500,
+                                  doc="Maximum number of authors looked up "
+                                      "by a single query.  Keep it below "
+                                      "the SQLite limit of 999 variables.")
+    max_density = IntOption('avatar', 'max_density', default=2,
+                            doc="Highest pixel density, e.g. 2 or 3, for "
+                                "which avatar variants are offered to high "
+                                "resolution displays through `srcset`.  "
+                                "1 disables it.")
+    inline_max_size = IntOption('avatar', 'inline_max_size', default=0,
+                                doc="Built-in avatars up to this size are "
+                                    "embedded in the page as data: URIs "
+                                    "instead of being requested one by one. "
+                                    "0 disables it.")
+    inline_cache_size = IntOption('avatar', 'inline_cache_size',
+                                  default=2048,
+                                  doc="Number of encoded avatars kept in "
+                                      "memory for inlining.")
 
     # A mapping of possible backends to their peculiarities
     external_backends = {
@@ -64,15 +107,27 @@ class AvatarBackend():
         },
     }
 
-    backends = {}
+    _missing = object()
+
+    # transparent 1x1 GIF, the visible image of a sprite is the background
+    BLANK_IMAGE = 'data:image/gif;base64,' \
+                  'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
 
     # from trac source
     _long_author_re = re.compile(r'.*<([^@]+)@([^@]+)>\s*|([^@]+)@([^@]+)')
 
-    def __init__(self, env, config):
+    def __init__(self, env, config, provider=None):
         self.env = env
         self.config = config
-        self.author_data = {}
+        self.provider = provider
+        self.backends = {}
+        # Authors of the page being rendered.  A thread serves a single
+        # request at a time, so thread local data is per request data.
+        self._local = threading.local()
+        self.author_cache = LRUCache(self.author_cache_size,
+                                     self.author_cache_ttl)
+        self.inline_cache = LRUCache(self.inline_cache_size)
+        self.metrics = AvatarMetrics(env)
 
         abs_href = self.env.abs_href()
 	if not abs_href.startswith('http'):
@@ -101,6 +156,14 @@ class AvatarBackend():
         }})
         self.backends.update(self.external_backends)
 
+    @property
+    def author_data(self):
+        try:
+            return self._local.author_data
+        except AttributeError:
+            self._local.author_data = {}
+            return self._local.author_data
+
     def get_backend(self):
         return self.backends[self.backend]
 
@@ -109,18 +172,34 @@ class AvatarBackend():
             self.author_data[author] = None
 
     def lookup_author_data(self):
+        with self.metrics.timer('lookup_author_data'):
+            self._lookup_author_data()
+
+    def _lookup_author_data(self):
         author_names = [a for a in self.author_data if a]
         lookup_authors = sorted([a for a in author_names if '@' not in a])
         email_authors = set(author_names).difference(lookup_authors)
 
-        if lookup_authors:
-            for sid, email in self.env.db_query("""
-                    SELECT sid, value FROM session_attribute
-                    WHERE name=%%s AND sid IN (%s)
-                    """ % ','.join(['%s'] * len(lookup_authors)),
-                    ('email',) + tuple(lookup_authors)):
-                self.author_data[sid] = self._avatar_slug(email)
+        missing = []
+        for author in lookup_authors:
+            # `None` is cached for authors without an email address.
+            slug = self.author_cache.get(author, self._missing)
+            if slug is self._missing:
+                missing.append(author)
+            elif slug is not None:
+                self.author_data[author] = slug
 
+        self.metrics.incr('lookup_author_data.authors', len(lookup_authors))
+        self.metrics.incr('lookup_author_data.cache_misses', len(missing))
+        if missing:
+            found = {}
+            for sid, email in self._query_emails(missing):
+                found[sid] = self.author_data[sid] = self._avatar_slug(email)
+            for author in missing:
+                self.author_cache.set(author, found.get(author))
+
+        # the hash is case insensitive, compute it once per address
+        slugs = {}
         for author in email_authors:
             author_info = self._long_author_re.match(author)
             if author_info:
@@ -130,30 +209,140 @@ class AvatarBackend():
                     name, host = author_info.group(3, 4)
                 else:
                     continue
+                address = ('%s@%s' % (name, host)).lower()
+                if address not in slugs:
+                    slugs[address] = self._avatar_slug(address)
                 self.author_data[name] = \
-                    self.author_data[author] = \
-                    self._avatar_slug('%s@%s' % (name, host))
+                    self.author_data[author] = slugs[address]
+
+    def _query_emails(self, sids):
+        """Yield `(sid, email)` of the given sids.
+
+        Large author sets are split into chunks of `lookup_chunk_size`
+        sids so that the queries stay below the variable limit of the
+        database, all of them on the same connection.
+        """
+        with self.env.db_query as db:
+            if len(sids) == 1:
+                self.metrics.incr('lookup_author_data.queries')
+                for row in db("""
+                        SELECT sid, value FROM session_attribute
+                        WHERE name=%s AND sid=%s
+                        """, ('email', sids[0])):
+                    yield row
+                return
+
+            chunk_size = max(1, self.lookup_chunk_size)
+            for i in xrange(0, len(sids), chunk_size):
+                chunk = sids[i:i + chunk_size]
+                self.metrics.incr('lookup_author_data.queries')
+                for row in db("""
+                        SELECT sid, value FROM session_attribute
+                        WHERE name=%%s AND sid IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)),
+                        ('email',) + tuple(chunk)):
+                    yield row
 
     def clear_auth_data(self):
-        self.author_data.clear()
+        self._local.author_data = {}
+        self._local.sprite = None
+
+    def prepare_sprite(self, size):
+        """Serve the avatars of `size` pixels of the collected authors
+        from one sprite sheet for the rest of the request."""
+        self._local.sprite = None
+        if self.backend != 'built-in' or self.provider is None:
+            return
+        hashes = set(slug or self._avatar_slug(author)
+                     for author, slug in self.author_data.iteritems()
+                     if author)
+        if len(hashes) < 2:
+            return
+        path, offsets = self.provider.sprite_path(hashes, int(size))
+        if path is None:
+            return
+        if self.is_https:
+            href = self.backends[self.backend]['base_ssl']
+        else:
+            href = self.backends[self.backend]['base']
+        self._local.sprite = (int(size), href + path, offsets)
+
+    def invalidate_author(self, sid):
+        """Forget the cached avatar hash of `sid`."""
+        self.author_cache.discard(sid)
 
     def generate_avatar(self, author, class_, size):
         if author is None or len(author) == 0:
             return tag.span()
         email_hash = self.author_data.get(author, None) or self._avatar_slug(author)
+
+        if self.backend == 'built-in' and self.provider is not None and \
+                int(size) <= self.inline_max_size:
+            try:
+                uri = self._inline_avatar(email_hash, int(size))
+            except Exception, e:
+                # let the browser request it
+                self.env.log.warning('Failed to inline avatar %s: %s',
+                                     email_hash, e)
+            else:
+                return tag.img(src=uri, class_='avatar %s' % class_,
+                               width=size, height=size).generate()
+
+        sprite = getattr(self._local, 'sprite', None)
+        if sprite is not None and sprite[0] == int(size) and \
+                email_hash in sprite[2]:
+            x, y = sprite[2][email_hash]
+            return tag.img(src=self.BLANK_IMAGE,
+                           style='background: url({}) no-repeat {}px {}px'
+                                 .format(sprite[1], -x, -y),
+                           class_='avatar %s' % class_,
+                           width=size, height=size).generate()
+        href = self._avatar_href(email_hash, size)
+        srcset = None
+        if self.backend in ('built-in', 'gravatar', 'libravatar'):
+            srcset = ', '.join(
+                    '{} {}x'.format(self._avatar_href(email_hash,
+                                                      int(size) * density),
+                                    density)
+                    for density in xrange(2, self.max_density + 1)) or None
+        return tag.img(src=href, srcset=srcset, class_='avatar %s' % class_,
+                       width=size, height=size).generate()
+
+    def is_proxied(self):
+        return self.proxy and self.provider is not None and \
+               self.backend in self.external_backends
+
+    def _avatar_href(self, email_hash, size):
+        backend = 'built-in' if self.is_proxied() else self.backend
         if self.is_https:
-            href = self.backends[self.backend]['base_ssl'] + email_hash
+            href = self.backends[backend]['base_ssl'] + email_hash
         else:
-            href = self.backends[self.backend]['base'] + email_hash
+            href = self.backends[backend]['base'] + email_hash
 
+        params = []
+        if self.backend == 'built-in' and self.provider is not None:
+            # The version changes whenever the image behind the hash does,
+            # so the URL can be cached forever.
+            params.append(('s', size))
+            params.append(('v', self.provider.avatar_version(email_hash)))
+        elif self.backend in ('gravatar', 'libravatar'):
+            params.append(('s', size))
         # for some reason sizing doesn't work if you pass "default=default"
         if self.default != 'default':
-            href += "&default=%s" % (self.default,)
-        return tag.img(src=href, class_='avatar %s' % class_, width=size, height=size).generate()
+            params.append(('default', self.default))
+        if params:
+            href += '?' + unicode_urlencode(params)
+        return href
+
+    def _inline_avatar(self, email_hash, size):
+        version = self.provider.avatar_version(email_hash)
+        key = (email_hash, size, version)
+        uri = self.inline_cache.get(key)
+        if uri is None:
+            png = self.provider.get_avatar_png(email_hash, size)
+            uri = 'data:image/png;base64,' + base64.b64encode(png)
+            self.inline_cache.set(key, uri)
+        return uri
 
     def _avatar_slug(self, email):
-        if email is None:
-            email = ''
-        if isinstance(email, unicode):
-            email = email.encode('utf-8')
-        return hashlib.md5(email.lower()).hexdigest()
+        return avatar_slug(email)
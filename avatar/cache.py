@@ -0,0 +1,311 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+class RenderCache(object):
+    """
+    On-disk cache of rendered avatars.
+
+    Entries are stored as ``<cache_dir>/<hash>/<variant>-<size>.<fmt>``
+    so that every rendition of a hash can be dropped at once.  The
+    modification time of an entry is refreshed when it is read, and the
+    least recently used entries are evicted when the cache grows beyond
+    `max_bytes`.
+    """
+
+    # Don't touch an entry on every hit, once a minute is precise enough.
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, cache_dir, max_bytes, log=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log = log
+        self._usage = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, email_hash, variant, size, fmt='png'):
+        return os.path.join(self.cache_dir, email_hash,
+                            '{}-{}.{}'.format(variant, size, fmt))
+
+    def lookup(self, email_hash, variant, size, fmt='png'):
+        """Return the path of a cached entry, or `None`."""
+        if not self.enabled:
+            return None
+        path = self.path(email_hash, variant, size, fmt)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        now = time.time()
+        if now - st.st_mtime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return path
+
+    def read(self, email_hash, variant, size, fmt='png'):
+        path = self.lookup(email_hash, variant, size, fmt)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def store(self, email_hash, variant, size, content, fmt='png'):
+        if not self.enabled:
+            return None
+        path = self.path(email_hash, variant, size, fmt)
+        dirname = os.path.dirname(path)
+        try:
+            if not os.access(dirname, os.F_OK):
+                os.makedirs(dirname)
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            replaced = self._size(path)
+            os.rename(tmppath, path)
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.warning('Failed to cache avatar %s: %s', path, e)
+            return None
+
+        with self._lock:
+            if self._usage is None:
+                self._usage = self._scan_usage()
+            else:
+                self._usage += len(content) - replaced
+            if self._usage > self.max_bytes:
+                self._evict()
+        return path
+
+    def invalidate(self, email_hash):
+        """Drop every rendition cached for the hash."""
+        if not email_hash:
+            return
+        dirname = os.path.join(self.cache_dir, email_hash)
+        removed = 0
+        for path, size, mtime in self._entries(dirname):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += size
+        shutil.rmtree(dirname, ignore_errors=True)
+        with self._lock:
+            if self._usage is not None:
+                self._usage = max(0, self._usage - removed)
+
+    def purge(self):
+        """Drop the whole cache."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        with self._lock:
+            self._usage = 0
+
+    def usage(self):
+        """Return the number of cached entries and their total size."""
+        count = total = 0
+        for path, size, mtime in self._entries():
+            count += 1
+            total += size
+        return count, total
+
+    def _entries(self, top=None):
+        for dirpath, dirnames, filenames in os.walk(top or self.cache_dir):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _size(self, path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    def _scan_usage(self):
+        return sum(size for path, size, mtime in self._entries())
+
+    def _evict(self):
+        # Shrink to 90% of the budget so that eviction doesn't run on
+        # every subsequent store.
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        usage = sum(e[1] for e in entries)
+        target = self.max_bytes * 9 // 10
+        for path, size, mtime in entries:
+            if usage <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            usage -= size
+            dirname = os.path.dirname(path)
+            if dirname != self.cache_dir:
+                try:
+                    # drop the directory of a hash with nothing left
+                    os.rmdir(dirname)
+                except OSError:
+                    pass
+        self._usage = usage
+        if self.log:
+            self.log.debug('Avatar cache evicted to %d bytes', usage)
+
+class LRUCache(object):
+    """
+    Thread-safe, bounded mapping which forgets the least recently used
+    entries first and counts its hits and misses.  Entries expire after
+    `ttl` seconds when it is given.
+    """
+
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key: the first caller runs
+    the function, the others wait for it and share its result.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls),
+            }
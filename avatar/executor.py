@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+
+class RenderUnavailable(Exception):
+    """
+    The render executor is saturated or the render timed out.
+    """
+
+def _call(function, args):
+    """
+    Run `function` in a pool worker and return `(ok, result)`.
+
+    Pools of Python 2 have no error callback, failures are returned so
+    that the completion callback always runs.
+    """
+
+    try:
+        return True, function(*args)
+    except Exception, e:
+        return False, e
+
+class RenderExecutor(object):
+    """
+    Run avatar renders inline, in a thread pool or in a process pool.
+
+    At most `queue_size` renders are queued or running at a time, further
+    renders fail immediately with `RenderUnavailable` instead of piling
+    up behind the busy workers.  A slot is only freed when its render
+    completes, also when the caller stopped waiting for it.  Functions
+    run by a process pool must be picklable, i.e. module level functions.
+    """
+
+    def __init__(self, mode='inline', workers=2, queue_size=16,
+                 timeout=None, log=None):
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.timeout = timeout or None
+        self.log = log
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_size = max(1, queue_size)
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def run(self, function, *args):
+        if self.mode == 'inline':
+            return function(*args)
+
+        slots = self._slots
+        if not slots.acquire(False):
+            self.rejected += 1
+            raise RenderUnavailable('render queue is full')
+        try:
+            result = self._get_pool().apply_async(
+                    _call, (function, args),
+                    callback=lambda result: slots.release())
+        except:
+            slots.release()
+            raise
+        try:
+            ok, value = result.get(self.timeout)
+        except TimeoutError:
+            # the render keeps its slot until it completes
+            self.timeouts += 1
+            raise RenderUnavailable('render timed out')
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+                # terminated renders never release their slots
+                self._slots = threading.BoundedSemaphore(self.queue_size)
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if self.mode == 'process':
+                        self._pool = Pool(self.workers)
+                    else:
+                        self._pool = ThreadPool(self.workers)
+                    if self.log:
+                        self.log.debug('Started avatar %s pool of %d workers',
+                                       self.mode, self.workers)
+        return self._pool
@@ -29,33 +29,143 @@
 
 import os
 import sys
+import copy
 import io
 import re
 import struct
+import tempfile
+import importlib
+import threading
 
-from PIL import Image
 from StringIO import StringIO
-from colorhash import ColorHash
-from cairosvg import svg2png
+
+from cache import LRUCache
+
+class _LazyModule(object):
+    """
+    Module imported on first attribute access.
+
+    Pillow, cairosvg (with cairocffi and the native cairo libraries) and
+    colorhash are only needed to render, loading them when the plugin is
+    imported would slow down the start of every Trac process.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+Image = _LazyModule('PIL.Image')
+ImageDraw = _LazyModule('PIL.ImageDraw')
+ImageFont = _LazyModule('PIL.ImageFont')
+
+# Shared by every request of the process, see get_cache_stats().
+_color_cache = LRUCache(4096)
+_png_cache = LRUCache(1024)
+_silhouette_cache = LRUCache(1024)
+
+_renderers = {}
+
+def get_renderer(renderer):
+    """
+    The rasterizer actually used for `renderer`: 'pillow' when cairosvg
+    or the cairo library can't be loaded.
+    """
+
+    if renderer != 'cairosvg':
+        return renderer
+    if renderer not in _renderers:
+        try:
+            from cairosvg import svg2png
+        except (ImportError, OSError):
+            # cairocffi raises OSError when libcairo is missing
+            svg2png = None
+        _renderers[renderer] = svg2png
+    return renderer if _renderers[renderer] is not None else 'pillow'
+
+def svg2png(**kwargs):
+    get_renderer('cairosvg')
+    if _renderers['cairosvg'] is None:
+        raise ImportError('cairosvg is required to render custom templates')
+    return _renderers['cairosvg'](**kwargs)
+
+def get_color(username):
+    """
+    Memoized ColorHash hex value of the username.
+    """
+
+    color = _color_cache.get(username)
+    if color is None:
+        from colorhash import ColorHash
+        color = ColorHash(username).hex
+        _color_cache.set(username, color)
+    return color
+
+def get_cache_stats():
+    return {
+        'color': _color_cache.stats(),
+        'png': _png_cache.stats(),
+        'silhouette': _silhouette_cache.stats(),
+    }
 
 class Avatar(object):
     """
     Avatar object skeleton class.
+
+    Generated avatars implement `create()`, which returns the SVG of
+    `template`, and `draw()`, which draws the default template with
+    Pillow.  The PNG is memoized by the SVG, so avatars which look the
+    same share one entry.
     """
 
-    def get_png(width, height):
-        raise 'must be override'
+    def create(self):
+        raise NotImplementedError
+
+    def draw(self):
+        raise NotImplementedError
+
+    def get_png(self):
+        renderer = get_renderer(self.renderer)
+        svg = self.create()
+        key = (self.__class__.__name__, svg, renderer, self.font)
+        png = _png_cache.get(key)
+        if png is None:
+            if renderer == 'pillow' and self.template is self.SVG_TEMPLATE:
+                png = _to_png(self.draw())
+            else:
+                png = svg2png(bytestring=svg)
+            _png_cache.set(key, png)
+        return png
+
+class ImageTooLarge(ValueError):
+    """
+    The dimensions of a picture exceed the decode limit.
+    """
 
 class PictureAvatar(Avatar):
     """
     Picture avatar class.
+
+    When `max_pixels` is given, pictures with more pixels are rejected
+    with `ImageTooLarge` from their header, before anything is decoded.
+    JPEG pictures are decoded directly at the smallest scale not below
+    `draft_size` when it is given.
     """
 
-    def __init__(self, filename, fd=None):
+    def __init__(self, filename, fd=None, max_pixels=None, draft_size=None):
         if fd is None:
             self.image = Image.open(filename, 'r')
         else:
             self.image = self._fromfiledata(fd, filename)
+        if max_pixels and self.width * self.height > max_pixels:
+            raise ImageTooLarge('{}x{} pixels'.format(self.width,
+                                                      self.height))
+        if draft_size and self.image.format == 'JPEG':
+            self.image.draft('RGB', (draft_size, draft_size))
 
     @property
     def width(self):
@@ -68,8 +178,24 @@ class PictureAvatar(Avatar):
     def resize(self, width, height):
         self.image.thumbnail((width, height))
 
+    def resized(self, width, height):
+        """Return a copy of the picture resized by `resize()`."""
+        pa = copy.copy(self)
+        pa.image = self.image.copy()
+        pa.resize(width, height)
+        return pa
+
     def save_to_png(self, path):
-        self.image.save(path, 'png')
+        """Save the picture as PNG, readers never see a partial file."""
+        dirname, basename = os.path.split(path)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.image.save(f, 'png')
+            os.rename(tmppath, path)
+        except:
+            os.remove(tmppath)
+            raise
 
     def get_png(self):
         stream = StringIO()
@@ -102,7 +228,7 @@ class PictureAvatar(Avatar):
         im = _open_core(fd, filename, prefix)
 
         if im is None:
-            if init():
+            if Image.init():
                 im = _open_core(fd, filename, prefix)
 
         if im:
@@ -131,16 +257,20 @@ class InitialAvatar(Avatar):
         self.template = self.SVG_TEMPLATE
         self.width    = width
         self.height   = height
+        self.renderer = 'cairosvg'
+        self.font     = None
 
     def set_template(self, template):
         if template:
             self.template = template
 
-    def create(self):
-        color = ColorHash(self.username)
+    def set_renderer(self, renderer, font=None):
+        self.renderer = renderer
+        self.font     = font
 
+    def create(self):
         svg_params = {
-            'color': color.hex,
+            'color': get_color(self.username),
             'initial': self.username[:2].upper(),
             'width': self.width,
             'height': self.height,
@@ -148,8 +278,34 @@ class InitialAvatar(Avatar):
 
         return self.template.format(**svg_params)
 
-    def get_png(self):
-        return svg2png(bytestring=self.create())
+    def draw(self):
+        """
+        Draw the default template with Pillow.
+        """
+
+        initial = self.username[:2].upper()
+        image = Image.new('RGB', (self.width, self.height),
+                          get_color(self.username))
+
+        # same geometry as the SVG template: a 220/256 font whose
+        # baseline is 0.36em below the middle.
+        px = max(1, self.height * 220 // 256)
+        font = _get_font(self.font, px)
+        draw = ImageDraw.Draw(image)
+        if hasattr(font, 'getbbox'):
+            left, top, right, bottom = font.getbbox(initial)
+            text_width = right - left
+        else:
+            left = 0
+            text_width = draw.textsize(initial, font=font)[0]
+        if hasattr(font, 'getmetrics'):
+            ascent = font.getmetrics()[0]
+            y = self.height / 2.0 + 0.36 * px - ascent
+        else:
+            y = (self.height - draw.textsize(initial, font=font)[1]) / 2.0
+        x = (self.width - text_width) / 2.0 - left
+        draw.text((x, y), initial, fill='#ffffff', font=font)
+        return image
 
 class SilhouetteAvatar(Avatar):
     """
@@ -169,26 +325,259 @@ class SilhouetteAvatar(Avatar):
     C248,221.124,227.491,209.396,195.919,197.89"/>
 </svg>"""
 
+    SVG_PATH = SVG_TEMPLATE[SVG_TEMPLATE.index(' d="') + 4:
+                            SVG_TEMPLATE.rindex('"/>')]
+
     def __init__(self, username, width, height):
         self.username = username
         self.template = self.SVG_TEMPLATE
         self.width    = width
         self.height   = height
+        self.renderer = 'cairosvg'
+        self.font     = None
 
     def set_template(self, template):
         if template:
             self.template = template
 
-    def create(self):
-        color = ColorHash(self.username)
+    def set_renderer(self, renderer, font=None):
+        self.renderer = renderer
 
+    def create(self):
         svg_params = {
-            'color': color.hex,
+            'color': get_color(self.username),
             'width': self.width,
             'height': self.height,
         }
 
         return self.template.format(**svg_params)
 
-    def get_png(self):
-        return svg2png(bytestring=self.create())
+    def draw(self):
+        """
+        Draw the default template with Pillow.
+        """
+
+        image = Image.new('RGB', (self.width, self.height),
+                          get_color(self.username))
+        mask = _get_silhouette_mask(self.SVG_PATH, self.width, self.height)
+        image.paste('#ffffff', (0, 0), mask)
+        return image
+
+def get_silhouette(name, size, fmt='png', renderer='cairosvg'):
+    """
+    Silhouette avatar of `name` encoded as `fmt`.
+
+    A silhouette only depends on the colour of the name and the size, so
+    all the names of the same colour share one cache entry.
+    """
+
+    key = (get_color(name), size, fmt, get_renderer(renderer))
+    content = _silhouette_cache.get(key)
+    if content is None:
+        avatar = SilhouetteAvatar(name, size, size)
+        avatar.set_renderer(renderer)
+        content = avatar.get_png()
+        if fmt != 'png':
+            content = convert_image(content, fmt)
+        _silhouette_cache.set(key, content)
+    return content
+
+def render_avatar(variant, name, filepath, size, renderer='cairosvg',
+                  font=None):
+    """
+    Render an avatar to PNG.
+
+    `variant` is 'picture' for the uploaded `filepath`, 'initial' for the
+    initials of the user `name` or 'silhouette' for an unknown `name`.
+    A module level function so that a process pool can run it.
+    """
+
+    if variant == 'picture':
+        pa = PictureAvatar(filepath)
+        pa.resize(size, size)
+        return pa.get_png()
+    elif variant == 'initial':
+        avatar = InitialAvatar(name, size, size)
+    else:
+        avatar = SilhouetteAvatar(name, size, size)
+    avatar.set_renderer(renderer, font)
+    return avatar.get_png()
+
+def get_supported_formats():
+    """
+    Lower-cased names of the image formats Pillow can encode.
+    """
+
+    Image.init()
+    return set(name.lower() for name in Image.SAVE)
+
+def convert_image(png, fmt):
+    """
+    Re-encode PNG data into `fmt`, e.g. 'webp' or 'avif'.
+    """
+
+    image = Image.open(StringIO(png))
+    if fmt in ('webp', 'avif') and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    stream = StringIO()
+    image.save(stream, fmt)
+    return stream.getvalue()
+
+def compose_sprite(pngs, size, columns):
+    """
+    Lay out square avatars of `size` pixels row by row on one sheet.
+    """
+
+    rows = max(1, (len(pngs) + columns - 1) // columns)
+    sheet = Image.new('RGBA', (columns * size, rows * size), (0, 0, 0, 0))
+    for i, png in enumerate(pngs):
+        image = Image.open(StringIO(png))
+        if image.width > size or image.height > size:
+            image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        sheet.paste(image, ((i % columns) * size, (i // columns) * size))
+    return _to_png(sheet)
+
+def _to_png(image):
+    stream = StringIO()
+    image.save(stream, 'png')
+    return stream.getvalue()
+
+_font_cache = {}
+_mask_cache = {}
+_cache_lock = threading.Lock()
+
+# Bound the per size caches, sizes come from the request.
+MAX_CACHED_SIZES = 64
+
+def has_font(path):
+    """
+    Whether Pillow can load the TrueType font `path`.
+    """
+
+    try:
+        ImageFont.truetype(path or 'DejaVuSans-Bold.ttf', 16)
+    except IOError:
+        return False
+    return True
+
+def _get_font(path, px):
+    key = (path, px)
+    font = _font_cache.get(key)
+    if font is None:
+        try:
+            font = ImageFont.truetype(path or 'DejaVuSans-Bold.ttf', px)
+        except IOError:
+            # checked by has_font() beforehand
+            font = ImageFont.load_default()
+        with _cache_lock:
+            if len(_font_cache) >= MAX_CACHED_SIZES:
+                _font_cache.clear()
+            _font_cache[key] = font
+    return font
+
+def _get_silhouette_mask(path, width, height):
+    key = (path, width, height)
+    mask = _mask_cache.get(key)
+    if mask is None:
+        # Supersample the polygon then scale it down for anti-aliasing.
+        scale = 4
+        big = Image.new('L', (width * scale, height * scale), 0)
+        draw = ImageDraw.Draw(big)
+        sx = width * scale / 256.0
+        sy = height * scale / 256.0
+        for polygon in _flatten_path(path):
+            draw.polygon([(x * sx, y * sy) for x, y in polygon], fill=255)
+        mask = big.resize((width, height), Image.LANCZOS)
+        with _cache_lock:
+            if len(_mask_cache) >= MAX_CACHED_SIZES:
+                _mask_cache.clear()
+            _mask_cache[key] = mask
+    return mask
+
+_path_token_re = re.compile(r'([MmLlHhVvCcSsZz])|'
+                            r'(-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+def _flatten_path(d, steps=16):
+    """
+    Flatten a SVG path into polygons.
+
+    Only the commands used by the silhouette template are supported:
+    M, L, H, V, C, S, Z and their relative forms.
+    """
+
+    tokens = []
+    for command, number in _path_token_re.findall(d):
+        tokens.append(command or float(number))
+
+    def bezier(p0, p1, p2, p3):
+        for i in xrange(1, steps + 1):
+            t = float(i) / steps
+            u = 1 - t
+            yield (u * u * u * p0[0] + 3 * u * u * t * p1[0] +
+                   3 * u * t * t * p2[0] + t * t * t * p3[0],
+                   u * u * u * p0[1] + 3 * u * u * t * p1[1] +
+                   3 * u * t * t * p2[1] + t * t * t * p3[1])
+
+    polygons = []
+    polygon = []
+    x = y = 0.0
+    control = None
+    command = None
+    i = 0
+    while i < len(tokens):
+        if isinstance(tokens[i], basestring):
+            command = tokens[i]
+            i += 1
+            if command in 'Zz':
+                if polygon:
+                    polygons.append(polygon)
+                polygon = []
+                continue
+        relative = command.islower()
+        op = command.upper()
+        ox, oy = (x, y) if relative else (0.0, 0.0)
+        if op == 'M':
+            if polygon:
+                polygons.append(polygon)
+            x, y = ox + tokens[i], oy + tokens[i + 1]
+            polygon = [(x, y)]
+            # subsequent pairs are implicit line-to commands
+            command = 'l' if relative else 'L'
+            i += 2
+            control = None
+        elif op == 'L':
+            x, y = ox + tokens[i], oy + tokens[i + 1]
+            polygon.append((x, y))
+            i += 2
+            control = None
+        elif op == 'H':
+            x = ox + tokens[i]
+            polygon.append((x, y))
+            i += 1
+            control = None
+        elif op == 'V':
+            y = oy + tokens[i]
+            polygon.append((x, y))
+            i += 1
+            control = None
+        elif op in 'CS':
+            if op == 'C':
+                c1 = (ox + tokens[i], oy + tokens[i + 1])
+                i += 2
+            elif control is not None:
+                c1 = (2 * x - control[0], 2 * y - control[1])
+            else:
+                c1 = (x, y)
+            c2 = (ox + tokens[i], oy + tokens[i + 1])
+            end = (ox + tokens[i + 2], oy + tokens[i + 3])
+            i += 4
+            polygon.extend(bezier((x, y), c1, c2, end))
+            x, y = end
+            control = c2
+        else:
+            raise ValueError('Unsupported path command {}'.format(command))
+    if polygon:
+        polygons.append(polygon)
+    return polygons
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import time
+import threading
+from contextlib import contextmanager
+
+from trac.core import *
+from trac.config import BoolOption
+
+class AvatarMetrics(Component):
+    """
+    Counters and timers of the avatar hot paths.
+
+    The values are kept in memory, so every process of a multi-process
+    server has its own.  Nothing is recorded unless `[avatar] metrics` is
+    enabled; every timing is then also written to the log at debug level.
+    """
+
+    enabled = BoolOption('avatar', 'metrics', default='false',
+                         doc="Record timings and counters of the avatar "
+                             "filter and handler, see the `/avatar-stats` "
+                             "page and `trac-admin $ENV avatar stats`.")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._since = time.time()
+
+    def incr(self, name, count=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            count, total, max_ = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds,
+                                  max(max_, seconds))
+        self.log.debug('avatar %s: %.2f ms', name, seconds * 1000)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block as `name`, also when it raises (`RequestDone`)."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def timed_filter(self, name, filter_):
+        """Wrap a stream filter to time its own work as `name`.
+
+        The filter runs lazily while the template is serialized, so the
+        time spent producing its input events is subtracted.
+        """
+        if not self.enabled:
+            return filter_
+
+        def timed(stream):
+            elapsed = [0.0]
+
+            def source():
+                events = iter(stream)
+                while True:
+                    start = time.time()
+                    try:
+                        event = next(events)
+                    except StopIteration:
+                        elapsed[0] -= time.time() - start
+                        return
+                    elapsed[0] -= time.time() - start
+                    yield event
+
+            events = iter(filter_(source()))
+            while True:
+                start = time.time()
+                try:
+                    event = next(events)
+                except StopIteration:
+                    elapsed[0] += time.time() - start
+                    break
+                elapsed[0] += time.time() - start
+                yield event
+            self.observe(name, elapsed[0])
+        return timed
+
+    def snapshot(self):
+        """Return the counters and timers as a JSON serializable dict."""
+        with self._lock:
+            timers = dict((name, {
+                'count': count,
+                'total_ms': total * 1000,
+                'mean_ms': total * 1000 / count,
+                'max_ms': max_ * 1000,
+            }) for name, (count, total, max_) in self._timers.iteritems())
+            return {
+                'enabled': self.enabled,
+                'since': int(self._since),
+                'counters': dict(self._counters),
+                'timers': timers,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self._since = time.time()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import time
+import socket
+import urllib2
+
+class AvatarProxy(object):
+    """
+    Fetch avatars from an upstream service (gravatar, libravatar) and
+    keep them in a `RenderCache`.
+
+    Fetched images are fresh for `ttl` seconds, then revalidated with
+    the upstream validators.  Hashes the upstream doesn't know (404 or
+    410) are remembered for `negative_ttl` seconds, so they don't hit
+    the upstream on every request.  When the upstream is unreachable or
+    fails otherwise, the stale image is served and retried after
+    `negative_ttl` seconds.
+    """
+
+    def __init__(self, cache, ttl, negative_ttl, timeout=5, log=None):
+        self.cache = cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.log = log
+
+    def get(self, url, email_hash, size):
+        """Return `(content, content_type, validator)`, or `None` when the
+        upstream has no image."""
+        meta = self._read_meta(email_hash, size)
+        now = time.time()
+        if meta is not None and now < meta['expires']:
+            if meta['status'] != 200:
+                return None
+            content = self.cache.read(email_hash, 'proxy', size, 'img')
+            if content is not None:
+                return content, meta['type'], meta['fetched']
+            meta = None
+
+        request = urllib2.Request(url)
+        if meta is not None and meta['status'] == 200 and \
+                self.cache.lookup(email_hash, 'proxy', size, 'img'):
+            # only revalidate what is still there to be served on a 304
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            content = response.read()
+            info = response.info()
+            content_type = info.gettype()
+            if not content_type.startswith('image/'):
+                raise IOError('unexpected content type ' + content_type)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and meta is not None:
+                content = self.cache.read(email_hash, 'proxy', size, 'img')
+                if content is not None:
+                    meta['expires'] = now + self.ttl
+                    self._write_meta(email_hash, size, meta)
+                    return content, meta['type'], meta['fetched']
+            return self._failed(email_hash, size, meta, e.code, e)
+        except (urllib2.URLError, socket.error, IOError), e:
+            return self._failed(email_hash, size, meta, None, e)
+
+        self.cache.store(email_hash, 'proxy', size, content, 'img')
+        meta = {
+            'status': 200,
+            'type': content_type,
+            'etag': info.getheader('ETag'),
+            'last_modified': info.getheader('Last-Modified'),
+            'fetched': now,
+            'expires': now + self.ttl,
+        }
+        self._write_meta(email_hash, size, meta)
+        return content, content_type, now
+
+    def _failed(self, email_hash, size, meta, status, error):
+        if self.log:
+            self.log.debug('Avatar %s not fetched: %s', email_hash, error)
+        if status in (404, 410):
+            # the upstream has no avatar for the hash
+            self._write_meta(email_hash, size, {
+                'status': status,
+                'expires': time.time() + self.negative_ttl,
+            })
+            return None
+        if meta is not None and meta['status'] == 200:
+            # upstream unreachable or failing, keep serving what we have
+            # and retry after `negative_ttl`
+            content = self.cache.read(email_hash, 'proxy', size, 'img')
+            if content is not None:
+                meta['expires'] = time.time() + self.negative_ttl
+                self._write_meta(email_hash, size, meta)
+                return content, meta['type'], meta['fetched']
+        return None
+
+    def _read_meta(self, email_hash, size):
+        data = self.cache.read(email_hash, 'proxy', size, 'json')
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def _write_meta(self, email_hash, size, meta):
+        self.cache.store(email_hash, 'proxy', size, json.dumps(meta), 'json')
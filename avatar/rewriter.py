@@ -0,0 +1,232 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+from genshi.core import START, END, TEXT
+
+class StreamRule(object):
+    """
+    Avatar insertion point, the single pass counterpart of a genshi
+    `Transformer`.
+
+    Only the XPath subset used by the avatar filters is understood:
+    `/` and `//` steps, element names or `*` and attribute equality
+    predicates combined with `or`, e.g.
+    `//table[@id="info"]//th|//td[@class="author" or @class="owner"]`.
+    Paths are parsed once into plain tag and attribute checks.
+    """
+
+    _parsed = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.alternatives = self._parse(path)
+        self.action = None
+        self.content = None
+
+    def prepend(self, content):
+        """Insert `content` right after the start tag."""
+        return self._set('prepend', content)
+
+    def append(self, content):
+        """Insert `content` right before the end tag."""
+        return self._set('append', content)
+
+    def before(self, content):
+        """Insert `content` before the start tag."""
+        return self._set('before', content)
+
+    def filter(self, function):
+        """Replace the matched element by `function(events)`."""
+        return self._set('filter', function)
+
+    @property
+    def names(self):
+        """Element names the rule can match, `*` for any."""
+        return set(steps[-1][1] for steps in self.alternatives)
+
+    def match(self, stack):
+        """Whether the last element of `stack` is selected."""
+        for steps in self.alternatives:
+            if self._match_at(steps, len(steps) - 1, stack, len(stack) - 1):
+                return True
+        return False
+
+    def events(self):
+        """The content to insert as a list of events."""
+        content = self.content
+        if callable(content):
+            content = content()
+        if content is None:
+            return []
+        if isinstance(content, basestring):
+            return [(TEXT, content, (None, -1, -1))]
+        return list(content)
+
+    def _set(self, action, content):
+        self.action = action
+        self.content = content
+        return self
+
+    def _match_at(self, steps, si, stack, ei):
+        axis, name, predicates = steps[si]
+        localname, attrs = stack[ei]
+        if name != '*' and name != localname:
+            return False
+        for alternatives in predicates:
+            for attr, value in alternatives:
+                if attrs.get(attr) == value:
+                    break
+            else:
+                return False
+        if si == 0:
+            return axis == '//' or ei == 0
+        if axis == '/':
+            return ei > 0 and self._match_at(steps, si - 1, stack, ei - 1)
+        for j in xrange(ei - 1, -1, -1):
+            if self._match_at(steps, si - 1, stack, j):
+                return True
+        return False
+
+    _step_re = re.compile(r'(//?)([\w\-]+|\*)((?:\[[^\]]*\])*)')
+    _predicate_re = re.compile(r'\[([^\]]*)\]')
+    _test_re = re.compile(r'''@([\w\-:]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+    @classmethod
+    def _parse(cls, path):
+        if path in cls._parsed:
+            return cls._parsed[path]
+        alternatives = []
+        for alternative in path.split('|'):
+            alternative = alternative.strip()
+            steps = []
+            pos = 0
+            while pos < len(alternative):
+                m = cls._step_re.match(alternative, pos)
+                if not m:
+                    raise ValueError('Unsupported path {!r}'.format(path))
+                predicates = []
+                for predicate in cls._predicate_re.findall(m.group(3)):
+                    tests = []
+                    for test in re.split(r'\s+or\s+', predicate.strip()):
+                        t = cls._test_re.match(test.strip())
+                        if not t:
+                            raise ValueError(
+                                'Unsupported predicate {!r}'.format(test))
+                        tests.append((t.group(1), t.group(2)
+                                      if t.group(2) is not None
+                                      else t.group(3)))
+                    predicates.append(tests)
+                steps.append((m.group(1), m.group(2), predicates))
+                pos = m.end()
+            alternatives.append(steps)
+        cls._parsed[path] = alternatives
+        return alternatives
+
+class StreamRewriter(object):
+    """
+    Apply a set of `StreamRule` in a single traversal of the stream.
+
+    Rules are looked up by element name so that most start tags are
+    checked against no rule at all.  Elements selected by a `filter`
+    rule are buffered until their end tag, as `Transformer.filter` does,
+    and rules still apply to their content.
+    """
+
+    def __init__(self, rules):
+        self.rules = [rule for rule in rules if rule is not None]
+        self._by_name = {}
+        for rule in self.rules:
+            for name in rule.names:
+                self._by_name.setdefault(name, []).append(rule)
+        self._any = self._by_name.pop('*', [])
+
+    def __call__(self, stream):
+        if not self.rules:
+            for event in stream:
+                yield event
+            return
+
+        stack = []      # (localname, attrs) of the open elements
+        appends = []    # `append` rules of the open elements
+        buffers = []    # [depth, rule, events] of the open filters
+        out = []
+
+        def write(events):
+            if buffers:
+                buffers[-1][2].extend(events)
+            else:
+                out.extend(events)
+
+        for event in stream:
+            kind = event[0]
+            if kind is START:
+                tag, attrs = event[1]
+                stack.append((tag.localname, attrs))
+                rules = self._by_name.get(tag.localname, ())
+                if self._any:
+                    rules = list(rules) + self._any
+                matched = [rule for rule in rules if rule.match(stack)]
+                after = []
+                ends = []
+                for rule in matched:
+                    if rule.action == 'before':
+                        write(rule.events())
+                    elif rule.action == 'prepend':
+                        after.extend(rule.events())
+                    elif rule.action == 'append':
+                        ends.append(rule)
+                    elif rule.action == 'filter':
+                        buffers.append([len(stack), rule, []])
+                appends.append(ends)
+                write([event])
+                write(after)
+            elif kind is END and stack:
+                for rule in appends.pop():
+                    write(rule.events())
+                write([event])
+                while buffers and buffers[-1][0] == len(stack):
+                    depth, rule, events = buffers.pop()
+                    write(rule.content(events))
+                stack.pop()
+            else:
+                write([event])
+
+            if out:
+                for e in out:
+                    yield e
+                del out[:]
+
+        # unbalanced stream, flush whatever is still buffered
+        while buffers:
+            depth, rule, events = buffers.pop()
+            write(events)
+        for e in out:
+            yield e
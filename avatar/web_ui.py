@@ -31,35 +31,68 @@ import os
 import sys
 import io
 import re
+import shutil
 import struct
+import math
 import hashlib
 import itertools
+import tempfile
+from email.utils import mktime_tz, parsedate_tz
+from wsgiref.util import FileWrapper
 
 from pkg_resources import resource_filename
 
 from trac.core import *
-from trac.config import Option
+from trac.cache import cached
+from trac.config import BoolOption, ChoiceOption, IntOption, ListOption, \
+                        Option
 from trac.db import DatabaseManager
 from trac.mimeview import *
 from trac.prefs import IPreferencePanelProvider
 from trac.ticket.model import Ticket
 from trac.resource import ResourceNotFound
 from trac.util import get_reporter_id
+from trac.util.datefmt import http_date
+from trac.util.text import unicode_urlencode
 from trac.util.translation import domain_functions
-from trac.web.api import IRequestHandler, ITemplateStreamFilter
+from trac.web.api import IRequestFilter, IRequestHandler, \
+                         ITemplateStreamFilter, HTTPNotFound, \
+                         HTTPServiceUnavailable, RequestDone
 from trac.web.chrome import ITemplateProvider, add_script, add_stylesheet
-from genshi.filters.transform import Transformer
 from genshi.builder import tag
 
-from image import PictureAvatar, InitialAvatar, SilhouetteAvatar
-from backend import AvatarBackend
+from image import ImageTooLarge, PictureAvatar, InitialAvatar, SilhouetteAvatar, \
+                  compose_sprite, convert_image, get_renderer, \
+                  get_silhouette, get_supported_formats, has_font, \
+                  render_avatar
+from backend import AvatarBackend, avatar_slug
+from cache import LRUCache, RenderCache, SingleFlight
+from executor import RenderExecutor, RenderUnavailable
+from metrics import AvatarMetrics
+from proxy import AvatarProxy
+from rewriter import StreamRule, StreamRewriter
 
 _, tag_, N_, add_domain = domain_functions('avatar',
     '_', 'tag_', 'N_', 'add_domain')
 
+def _after_session_save(req, function, *args):
+    """Call `function` once the session changed by the request handler
+    is saved.
+
+    Trac saves the session when it sends the response status, which for
+    the preference panels is their redirect.  Invalidating any earlier
+    would let concurrent requests cache the old values again.
+    """
+    send_response = req.send_response
+    def wrapper(code=200):
+        send_response(code)
+        if code < 400:
+            function(*args)
+    req.send_response = wrapper
+
 class AvatarModule(Component):
 
-    implements(ITemplateStreamFilter, ITemplateProvider)
+    implements(IRequestFilter, ITemplateStreamFilter, ITemplateProvider)
 
     ticket_reporter_size = Option('avatar', 'ticket_reporter_size', default='60')
     ticket_owner_size = Option('avatar', 'ticket_owner_size', default='20')
@@ -83,6 +116,11 @@ class AvatarModule(Component):
                          "backend.  Currently built-in, gravatar and libravatar "
                          "are supported.")
     show_avatar_detail = Option('avatar', 'show_avatar_detail', default='disabled')
+    sprites = BoolOption('avatar', 'sprites', default='false',
+                         doc="Serve the avatars of report, query, timeline "
+                             "and log pages from one sprite sheet per page "
+                             "instead of one image per row.  Requires the "
+                             "built-in backend.")
 
     def __init__(self):
 
@@ -90,9 +128,34 @@ class AvatarModule(Component):
             if self.select_backend == 'built-in':
                 self.config.set('avatar', 'backend', 'gravatar')
 
-        self.backend = AvatarBackend(self.env, self.config)
+        provider = None
+        if self.env.is_component_enabled(AvatarProvider):
+            provider = AvatarProvider(self.env)
+        self.backend = AvatarBackend(self.env, self.config, provider)
+        self.metrics = AvatarMetrics(self.env)
+
+    PAGE_TYPES = ('ticket', 'report', 'query', 'timeline', 'browser', 'log',
+                  'search', 'wiki', 'attachment', 'prefs')
 
     def filter_stream(self, req, method, filename, stream, data):
+        page = req.path_info.split('/', 2)[1] if req.path_info else ''
+        if page not in self.PAGE_TYPES:
+            page = 'other'
+        self.metrics.incr('filter_stream.{}.pages'.format(page))
+        with self.metrics.timer('filter_stream.{}.prepare'.format(page)):
+            filter_ = self._prepare_filters(req, data)
+        stream |= self.metrics.timed_filter(
+                'filter_stream.{}.rewrite'.format(page),
+                StreamRewriter(filter_))
+
+        if self.show_avatar_detail == 'enabled':
+            add_script(req, 'avatar/js/avatar.js')
+        add_stylesheet(req, 'avatar/css/avatar.css')
+        return stream
+
+    def _prepare_filters(self, req, data):
+        """Return the stream rules of the page, with the avatar hashes of
+        its authors looked up."""
         filter_ = []
         context = {
             'data': data,
@@ -128,19 +191,40 @@ class AvatarModule(Component):
             pass
 
         self.backend.lookup_author_data()
-        for f in filter_:
-            if f is not None:
-                stream |= f
+        sprite_size = self._sprite_size(req)
+        if sprite_size:
+            self.backend.prepare_sprite(sprite_size)
+        return filter_
 
-        if self.show_avatar_detail == 'enabled':
-            add_script(req, 'avatar/js/avatar.js')
-        add_stylesheet(req, 'avatar/css/avatar.css')
-        return stream
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if req.method == 'POST' and req.path_info.startswith('/prefs') \
+           and 'email' in req.args \
+           and req.args.get('email') != req.session.get('email'):
+            _after_session_save(req, self.backend.invalidate_author,
+                                req.authname)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
 
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
         yield 'avatar', resource_filename(__name__, 'htdocs')
 
+    def _sprite_size(self, req):
+        if not self.sprites or self.select_backend != 'built-in':
+            return None
+        if req.path_info.startswith('/report') or \
+                req.path_info.startswith('/query'):
+            return self.report_size
+        elif req.path_info.startswith('/timeline'):
+            return self.timeline_size
+        elif req.path_info.startswith('/log'):
+            return self.browser_lineitem_size
+        return None
+
     def get_templates_dirs(self):
         return []
 
@@ -153,7 +237,7 @@ class AvatarModule(Component):
         email = data['email']
 
         xpath = '//*/div[@id="metanav"]/ul/li[@class="first"]'
-        return [Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(
             self.backend.generate_avatar(
                 email,
                 'metanav-avatar',
@@ -181,8 +265,18 @@ class AvatarModule(Component):
 
         if 'tickets' in data:
             class_ = 'query'
+            for ticket in data['tickets']:
+                self.backend.collect_author(ticket.get('owner'))
+                self.backend.collect_author(ticket.get('reporter'))
         elif 'row_groups' in data:
             class_ = 'report'
+            for group, rows in data['row_groups']:
+                for row in rows:
+                    for cells in row.get('cell_groups', []):
+                        for cell in cells:
+                            header = cell.get('header') or {}
+                            if header.get('col') in ('owner', 'reporter'):
+                                self.backend.collect_author(cell.get('value'))
 
         def find_change(stream):
             author = ''.join(stream_part[1] for stream_part in stream if stream_part[0] == 'TEXT').strip()
@@ -193,7 +287,7 @@ class AvatarModule(Component):
             return itertools.chain([stream[0]], tag, stream[1:])
 
         xpath = '//table[@class="listing tickets"]/tbody/tr/td[@class="owner"]|//table[@class="listing tickets"]/tbody/tr/td[@class="reporter"]'
-        return [Transformer(xpath).filter(find_change)]
+        return [StreamRule(xpath).filter(find_change)]
 
     def _browser_filter(self, context):
         data = context['data']
@@ -213,11 +307,11 @@ class AvatarModule(Component):
         author = data['file']['changeset'].author
         self.backend.collect_author(author)
         xpath = '//table[@id="info"]//th'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                         author,
                         'browser-changeset',
-                        self.browser_changeset_size))(stream),
+                        self.browser_changeset_size)),
         ]
 
     def _prefs_filter(self, context):
@@ -231,7 +325,7 @@ class AvatarModule(Component):
 
         backend_ = self.backend.get_backend()
         xpath = '//form[@id="userprefs"]/table'
-        return [Transformer(xpath).append(
+        return [StreamRule(xpath).append(
                 tag.tr(
                         tag.th(
                                 tag.label(
@@ -277,7 +371,7 @@ class AvatarModule(Component):
             return itertools.chain([stream[0]], tag, stream[1:])
 
         xpath = '//dl[@id="results"]//span[@class="trac-author-user" or @class="trac-author"]'
-        return [Transformer(xpath).filter(_find_result)]
+        return [StreamRule(xpath).filter(_find_result)]
 
     def _browser_lineitem_filter(self, context):
         data = context['data']
@@ -298,7 +392,7 @@ class AvatarModule(Component):
             return itertools.chain([stream[0]], tag, stream[1:])
 
         xpath = '//td[@class="author"]'
-        return [Transformer(xpath).filter(find_change)]
+        return [StreamRule(xpath).filter(find_change)]
 
     def _ticket_reporter_filter(self, context):
         data = context['data']
@@ -308,11 +402,11 @@ class AvatarModule(Component):
         self.backend.collect_author(author)
 
         xpath = '//div[@id="ticket"]'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                         author,
                         'ticket-reporter',
-                        self.ticket_reporter_size))(stream),
+                        self.ticket_reporter_size)),
         ]
 
     def _ticket_owner_filter(self, context):
@@ -323,11 +417,11 @@ class AvatarModule(Component):
         self.backend.collect_author(author)
 
         xpath = '//td[@headers="h_owner"]'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                         author,
                         'ticket-owner',
-                        self.ticket_owner_size))(stream),
+                        self.ticket_owner_size)),
         ]
 
     def _ticket_comment_filter(self, context):
@@ -355,7 +449,7 @@ class AvatarModule(Component):
             return itertools.chain([next(stream)], tag, stream)
 
         xpath = '//div[@id="changelog"]/div[@class="change"]/h3[@class="change"]'
-        return [Transformer(xpath).filter(_find_change)]
+        return [StreamRule(xpath).filter(_find_change)]
 
     def _ticket_comment_diff_filter(self, context):
         data = context['data']
@@ -363,11 +457,11 @@ class AvatarModule(Component):
         author = data['change']['author']
         self.backend.collect_author(author)
         xpath = '//dd[@class="author"]'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                         author,
                         'ticket-comment-diff',
-                        self.ticket_comment_diff_size))(stream),
+                        self.ticket_comment_diff_size)),
         ]
 
     def _ticket_comment_history_filter(self, context):
@@ -395,7 +489,7 @@ class AvatarModule(Component):
             return itertools.chain([next(stream)], tag, stream)
 
         xpath = '//table[@id="fieldhist"]//td[@class="author"]'
-        return [Transformer(xpath).filter(_find_change)]
+        return [StreamRule(xpath).filter(_find_change)]
 
     def _timeline_filter(self, context):
         data = context['data']
@@ -418,7 +512,7 @@ class AvatarModule(Component):
             return itertools.chain(tag, stream)
 
         xpath = '//div[@id="content"]/dl/dt/a/span[@class="time"]'
-        return [Transformer(xpath).filter(find_change)]
+        return [StreamRule(xpath).filter(find_change)]
 
     def _wiki_filter(self, context):
         query = context.get('query', '')
@@ -438,11 +532,11 @@ class AvatarModule(Component):
         author = data['change']['author']
         self.backend.collect_author(author)
         xpath = '//dd[@class="author"]'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                         author,
                         'wiki-diff',
-                        self.wiki_diff_size))(stream),
+                        self.wiki_diff_size)),
         ]
 
     def _wiki_history_filter(self, context):
@@ -457,7 +551,7 @@ class AvatarModule(Component):
             return itertools.chain([stream[0]], tag, stream[1:])
 
         xpath = '//td[@class="author"]'
-        return [Transformer(xpath).filter(_find_change)]
+        return [StreamRule(xpath).filter(_find_change)]
 
     def _wiki_version_filter(self, context):
         data = context['data']
@@ -467,11 +561,11 @@ class AvatarModule(Component):
 
         author = data['page'].author
         xpath = '//table[@id="info"]//th'
-        return [lambda stream: Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(lambda:
                 self.backend.generate_avatar(
                     author,
                     'wiki-version',
-                    self.wiki_version_size))(stream),
+                    self.wiki_version_size)),
         ]
 
     def _attachment_filter(self, context):
@@ -484,7 +578,7 @@ class AvatarModule(Component):
             return []
 
         xpath = '//table[@id="info"]//th'
-        return [Transformer(xpath).prepend(
+        return [StreamRule(xpath).prepend(
                 self.backend.generate_avatar(
                             author,
                             'attachment-view',
@@ -504,13 +598,94 @@ class AvatarModule(Component):
 
         xpath  = '//div[@id="attachments"]/div/ul/li/span[@class="trac-author-user" or @class="trac-author"]'
         xpath += '|//div[@id="attachments"]/div[@class="attachments"]/dl[@class="attachments"]/dt/span[@class="trac-author-user" or @class="trac-author"]'
-        return [Transformer(xpath).filter(_find_change)]
+        return [StreamRule(xpath).filter(_find_change)]
 
 class AvatarProvider(Component):
 
     AVATAR_SIZE = 128
+    IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+    cache_size = IntOption('avatar', 'cache_size', default=64 * 1024 * 1024,
+                           doc="Maximum number of bytes used by the cache "
+                               "of rendered avatars under "
+                               "`files/avatars/cache`, and by the one of "
+                               "sprite sheets under `files/avatars/sprites`. "
+                               " 0 disables them.")
+    cache_max_age = IntOption('avatar', 'cache_max_age', default=3600,
+                              doc="Number of seconds browsers may use an "
+                                  "avatar without revalidating it.")
+    renderer = ChoiceOption('avatar', 'renderer', ['cairosvg', 'pillow'],
+                            doc="Rasterizer of the initial and silhouette "
+                                "avatars.  `pillow` draws them directly "
+                                "and is much faster, `cairosvg` renders "
+                                "the SVG template.")
+    formats = ListOption('avatar', 'formats', default='webp, png',
+                         doc="Image formats offered to browsers which "
+                             "accept them, in order of preference.  "
+                             "`avif` and `webp` are only used when Pillow "
+                             "supports them, `png` is always available.")
+    font = Option('avatar', 'font', default='DejaVuSans-Bold.ttf',
+                  doc="TrueType font of the initials drawn by the `pillow` "
+                      "renderer.  When it can't be loaded, avatars are "
+                      "rendered with `cairosvg` if available.")
+    max_upload_size = IntOption('avatar', 'max_upload_size',
+                                default=10 * 1024 * 1024,
+                                doc="Maximum size in bytes of an uploaded "
+                                    "avatar picture.")
+    max_upload_pixels = IntOption('avatar', 'max_upload_pixels',
+                                  default=50 * 1000 * 1000,
+                                  doc="Maximum number of pixels (width "
+                                      "times height) of an uploaded avatar "
+                                      "picture.  Larger pictures are "
+                                      "rejected before they are decoded.")
+    proxy_ttl = IntOption('avatar', 'proxy_ttl', default=86400,
+                          doc="Seconds an avatar fetched from gravatar or "
+                              "libravatar is used before it is revalidated "
+                              "(see `proxy`).")
+    proxy_negative_ttl = IntOption('avatar', 'proxy_negative_ttl',
+                                   default=3600,
+                                   doc="Seconds a hash unknown to the "
+                                       "upstream service is remembered, "
+                                       "and a stale avatar served while the "
+                                       "service fails.")
+    proxy_timeout = IntOption('avatar', 'proxy_timeout', default=5,
+                              doc="Seconds to wait for the upstream service.")
+    proxy_upstream = Option('avatar', 'proxy_upstream', default='',
+                            doc="Base URL avatars are fetched from in "
+                                "`proxy` mode, defaults to the URL of the "
+                                "configured backend.")
+    unknown_hash_cache_size = IntOption('avatar', 'unknown_hash_cache_size',
+                                        default=4096,
+                                        doc="Number of hashes without a "
+                                            "user remembered so that their "
+                                            "requests skip the hash index.")
+    unknown_hash_ttl = IntOption('avatar', 'unknown_hash_ttl', default=300,
+                                 doc="Seconds a hash without a user is "
+                                     "remembered, i.e. how long a new "
+                                     "email address registered through "
+                                     "another server process may still "
+                                     "get a silhouette.")
+    render_executor = ChoiceOption('avatar', 'render_executor',
+                                   ['inline', 'thread', 'process'],
+                                   doc="Where avatars are rendered: on the "
+                                       "request thread, in a thread pool or "
+                                       "in a process pool.")
+    render_workers = IntOption('avatar', 'render_workers', default=2,
+                               doc="Number of workers of the render pool.")
+    render_queue_size = IntOption('avatar', 'render_queue_size', default=16,
+                                  doc="Maximum number of renders queued or "
+                                      "running in the render pool.")
+    render_timeout = IntOption('avatar', 'render_timeout', default=10,
+                               doc="Seconds to wait for a render of the "
+                                   "render pool.")
+    render_overload = ChoiceOption('avatar', 'render_overload',
+                                   ['silhouette', 'unavailable'],
+                                   doc="Response when the render pool is "
+                                       "full or times out: a silhouette or "
+                                       "`503 Service Unavailable`.")
 
     implements(IRequestHandler,
+               IRequestFilter,
                IPreferencePanelProvider,
                ITemplateProvider)
 
@@ -518,6 +693,46 @@ class AvatarProvider(Component):
         # bind the 'avatar' catalog to the locale directory
         add_domain(self.env.path, resource_filename(__name__, 'locale'))
 
+        self.ladder_sizes = self._get_ladder_sizes()
+        # Sizes come from anonymous query strings, nothing on the pages
+        # needs more than the largest configured size.
+        self.max_size = max([self.AVATAR_SIZE] + self.get_avatar_sizes())
+        # only one thread renders a given avatar at a time
+        self.renders = SingleFlight()
+        self.unknown_hashes = LRUCache(self.unknown_hash_cache_size,
+                                       self.unknown_hash_ttl)
+        self.executor = RenderExecutor(self.render_executor,
+                                       self.render_workers,
+                                       self.render_queue_size,
+                                       self.render_timeout, self.log)
+        self._output_formats = None
+        self._renderer = None
+        self._fingerprint = None
+        self.render_cache = RenderCache(
+                os.path.join(os.path.normpath(self.env.path),
+                             'files', 'avatars', 'cache'),
+                self.cache_size, self.log)
+        # apart from the avatars, which are dropped per hash
+        self.sprite_cache = RenderCache(
+                os.path.join(os.path.normpath(self.env.path),
+                             'files', 'avatars', 'sprites'),
+                self.cache_size, self.log)
+        self.metrics = AvatarMetrics(self.env)
+        self.proxy = AvatarProxy(self.render_cache, self.proxy_ttl,
+                                 self.proxy_negative_ttl, self.proxy_timeout,
+                                 self.log)
+
+    @property
+    def output_formats(self):
+        """The offered formats besides PNG which Pillow can encode."""
+        # Determined on first use, not to load Pillow on startup.
+        if self._output_formats is None:
+            supported = get_supported_formats()
+            self._output_formats = [fmt.lower() for fmt in self.formats
+                                    if fmt.lower() in supported and
+                                       fmt.lower() != 'png']
+        return self._output_formats
+
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
         return [('avatar', resource_filename(__name__, 'htdocs'))]
@@ -530,46 +745,596 @@ class AvatarProvider(Component):
         return match
 
     def process_request(self, req):
+        with self.metrics.timer('process_request'):
+            self._process_request(req)
+
+    def _process_request(self, req):
+        email_hash = None
         match = re.search(r'(\w+)$', req.path_info)
         if match:
             email_hash = match.groups(1)[0]
 
-        m = re.match(r's=(?P<size>\d+)', req.query_string)
+        m = re.search(r'(?:^|&)s=(?P<size>\d+)', req.query_string)
         if m:
-            size = int(m.group('size'))
+            size = min(max(1, int(m.group('size'))), self.max_size)
         else:
             size = self.AVATAR_SIZE
-        fmt = 'png'
+
+        if re.search(r'/avatar/sprite/\w+$', req.path_info):
+            self._process_sprite(req, email_hash, size)
+            return
+
+        backend = self.config.get('avatar', 'backend')
+        if self.config.getbool('avatar', 'proxy') and \
+                backend in AvatarBackend.external_backends and \
+                self._variant(self.lookup_hash(email_hash)) != 'picture':
+            # uploaded pictures still take precedence
+            self._process_proxy(req, backend, email_hash, size)
+
+        m = re.search(r'(?:^|&)v=(?P<version>\w+)', req.query_string)
+        version = m.group('version') if m else None
+        fmt = self._negotiate_format(req)
         mime_type = 'image/{}'.format(fmt)
 
-        if email_hash:
-            for sid, email, in self.env.db_query("""
-                    SELECT sid, value FROM session_attribute
-                    WHERE name='email'
-                    """):
-                if sid == email_hash \
-                   or email == email_hash \
-                   or hashlib.md5(sid.lower()).hexdigest() == email_hash \
-                   or hashlib.md5(email.lower()).hexdigest() == email_hash:
-
-                    result = self.env.db_query("""
-                            SELECT value FROM session_attribute
-                            WHERE name='avatar' AND sid=%s
-                            """,
-                            (sid,))
-                    if result is not None and len(result) > 0:
-                        filepath, = result[0]
-                        pa = PictureAvatar(filepath)
-                        pa.resize(size, size)
-                        req.send(pa.get_png(), mime_type)
-                        return
-                    else:
-                        ia = InitialAvatar(sid, size, size)
-                        req.send(ia.get_png(), mime_type)
-                        return
-
-        sa = SilhouetteAvatar(email_hash, size, size)
-        req.send(sa.get_png(), mime_type)
+        with self.metrics.timer('process_request.lookup'):
+            entry = self.lookup_hash(email_hash)
+            variant = self._variant(entry)
+            mtime = entry[2] if variant == 'picture' else None
+            if version is not None and version == self._version(entry):
+                cache_control = 'max-age={}, immutable'.format(self.IMMUTABLE_MAX_AGE)
+            else:
+                cache_control = 'max-age={}'.format(self.cache_max_age)
+            headers = [
+                ('ETag', self._etag(email_hash, entry,
+                                    self._cache_variant(variant), size, fmt)),
+                ('Cache-Control', cache_control),
+            ]
+            if self.output_formats:
+                headers.append(('Vary', 'Accept'))
+            if mtime is not None:
+                headers.append(('Last-Modified', http_date(mtime)))
+        self._check_modified(req, headers[0][1], mtime, headers)
+
+        path = self._find_avatar_file(email_hash, entry, variant, size, fmt)
+        if path is not None:
+            self.metrics.incr('process_request.file')
+            self._send_file(req, path, mime_type, headers)
+
+        try:
+            content = self.renders.do((email_hash, variant, size, fmt),
+                                      self._get_avatar,
+                                      email_hash, entry, variant, size, fmt)
+        except RenderUnavailable, e:
+            self.metrics.incr('process_request.unavailable')
+            self.log.warning('Avatar %s not rendered: %s', email_hash, e)
+            if self.render_overload == 'unavailable':
+                raise HTTPServiceUnavailable(_('Avatar rendering is busy'))
+            # don't let anybody cache the stand-in
+            sa = SilhouetteAvatar(email_hash, size, size)
+            sa.set_renderer(self.renderer)
+            self._send_avatar(req, sa.get_png(), 'image/png',
+                              [('Cache-Control', 'no-store')])
+        self._send_avatar(req, content, mime_type, headers)
+
+    def _find_avatar_file(self, email_hash, entry, variant, size, fmt):
+        """Return the path of an already rendered avatar, or `None`."""
+        if variant == 'silhouette':
+            return None  # kept in memory, see _get_avatar()
+        if fmt == 'png' and variant == 'picture':
+            path = self._ladder_file(entry[1], size)
+            if path is not None:
+                return path
+        return self.render_cache.lookup(email_hash,
+                                        self._cache_variant(variant), size, fmt)
+
+    def _negotiate_format(self, req):
+        """Pick the preferred output format accepted by the client."""
+        if not self.output_formats:
+            return 'png'
+        accepted = set()
+        for item in (req.get_header('Accept') or '').split(','):
+            params = item.strip().split(';')
+            q = 1.0
+            for param in params[1:]:
+                name, _sep, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                accepted.add(params[0].strip().lower())
+        for fmt in self.output_formats:
+            if 'image/{}'.format(fmt) in accepted:
+                return fmt
+        return 'png'
+
+    def get_avatar_png(self, email_hash, size):
+        """Return the PNG image of the avatar of `email_hash`."""
+        return self.get_avatar(email_hash, size)
+
+    def get_avatar(self, email_hash, size, fmt='png'):
+        """Return the avatar of `email_hash` encoded as `fmt`, rendering
+        and caching it when needed."""
+        entry = self.lookup_hash(email_hash)
+        return self._get_avatar(email_hash, entry, self._variant(entry),
+                                size, fmt)
+
+    def _get_avatar(self, email_hash, entry, variant, size, fmt='png'):
+        if variant == 'silhouette':
+            # Shared by every unknown hash of the same colour, so crawlers
+            # and authors without a session don't fill the render cache.
+            return get_silhouette(email_hash, size, fmt,
+                                  self._get_renderer())
+
+        cache_variant = self._cache_variant(variant)
+        if fmt != 'png':
+            content = self.render_cache.read(email_hash, cache_variant, size,
+                                             fmt)
+            if content is None:
+                png = self._get_avatar(email_hash, entry, variant, size)
+                with self.metrics.timer('process_request.encode'):
+                    content = convert_image(png, fmt)
+                self.render_cache.store(email_hash, cache_variant, size,
+                                        content, fmt)
+            return content
+
+        content = None
+        if variant == 'picture':
+            content = self._read_ladder(entry[1], size)
+        if content is None:
+            content = self.render_cache.read(email_hash, cache_variant, size)
+        if content is None:
+            self.metrics.incr('render_cache.misses')
+            # includes decoding the uploaded picture
+            with self.metrics.timer('process_request.render'):
+                content = self._render(entry, email_hash, variant, size)
+            self.render_cache.store(email_hash, cache_variant, size, content)
+        else:
+            self.metrics.incr('render_cache.hits')
+        return content
+
+    def _etag(self, email_hash, entry, variant, size, fmt):
+        key = u'{}:{}:{}:{}:{}'.format(email_hash, self._version(entry),
+                                        variant, size, fmt)
+        return '"{}"'.format(avatar_slug(key))
+
+    def _check_modified(self, req, etag, mtime, headers):
+        """Send `304 Not Modified` if the client copy is still valid."""
+        inm = req.get_header('If-None-Match')
+        if inm:
+            tags = [t.strip() for t in inm.split(',')]
+            modified = etag not in tags and '*' not in tags
+        elif mtime is not None and req.get_header('If-Modified-Since'):
+            since = parsedate_tz(req.get_header('If-Modified-Since'))
+            modified = since is None or mktime_tz(since) < mtime
+        else:
+            modified = True
+        if modified:
+            return
+
+        self.metrics.incr('process_request.not_modified')
+        req.send_response(304)
+        for name, value in headers:
+            req.send_header(name, value)
+        req.send_header('Content-Length', 0)
+        req.end_headers()
+        raise RequestDone
+
+    def _send_avatar(self, req, content, mime_type, headers):
+        req.send_response(200)
+        req.send_header('Content-Type', mime_type)
+        req.send_header('Content-Length', len(content))
+        for name, value in headers:
+            req.send_header(name, value)
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
+
+    def _send_file(self, req, path, mime_type, headers):
+        """Stream an avatar from disk.
+
+        Unlike `req.send_file()`, the validators are the ones of the
+        avatar: the modification time of a cached file only tells when
+        it was last used.  Returns if the file has just been evicted.
+        """
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            req.send_response(200)
+            req.send_header('Content-Type', mime_type)
+            req.send_header('Content-Length',
+                            os.fstat(fileobj.fileno()).st_size)
+            for name, value in headers:
+                req.send_header(name, value)
+            req.end_headers()
+        except:
+            fileobj.close()
+            raise
+        if req.method == 'HEAD':
+            fileobj.close()
+        else:
+            file_wrapper = req.environ.get('wsgi.file_wrapper', FileWrapper)
+            req._response = file_wrapper(fileobj, 4096)
+        raise RequestDone
+
+    def _variant(self, entry):
+        if entry is None:
+            return 'silhouette'
+        elif entry[1] is not None:
+            return 'picture'
+        else:
+            return 'initial'
+
+    def _cache_variant(self, variant):
+        """The name `variant` is cached and tagged under: generated
+        avatars also change with the renderer, the font and the
+        templates."""
+        if variant == 'picture':
+            return variant
+        return '{}.{}'.format(variant, self._render_fingerprint())
+
+    def _render_fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = avatar_slug(u'\n'.join([
+                    self._get_renderer(), self.font,
+                    InitialAvatar.SVG_TEMPLATE,
+                    SilhouetteAvatar.SVG_TEMPLATE]))[:8]
+        return self._fingerprint
+
+    def _render(self, entry, email_hash, variant, size):
+        if variant == 'picture':
+            name, filepath = entry[0], entry[1]
+        elif variant == 'initial':
+            name, filepath = entry[0], None
+        else:
+            name, filepath = email_hash, None
+        return self.executor.run(render_avatar, variant, name, filepath,
+                                 size, self._get_renderer(), self.font)
+
+    def _get_renderer(self):
+        """The rasterizer, chosen on the first render."""
+        if self._renderer is None:
+            renderer = get_renderer(self.renderer)
+            if renderer != self.renderer:
+                self.log.warning('cairosvg can\'t be loaded, avatars are '
+                                 'rendered with pillow')
+            if renderer == 'pillow' and not has_font(self.font):
+                if get_renderer('cairosvg') == 'cairosvg':
+                    self.log.warning('Font %s can\'t be loaded, avatars are '
+                                     'rendered with cairosvg', self.font)
+                    renderer = 'cairosvg'
+                else:
+                    self.log.warning('Font %s can\'t be loaded, initials '
+                                     'are drawn with the default bitmap '
+                                     'font', self.font)
+            self._renderer = renderer
+        return self._renderer
+
+    # Proxy
+
+    def _process_proxy(self, req, backend, email_hash, size):
+        base = self.proxy_upstream or \
+               AvatarBackend.external_backends[backend]['base_ssl']
+        params = [('s', size)]
+        default = self.config.get('avatar', 'avatar_default')
+        if default and default != 'default':
+            params.append(('default', default))
+        url = base + email_hash + '?' + unicode_urlencode(params)
+
+        result = self.renders.do(('proxy', email_hash, size),
+                                 self.proxy.get, url, email_hash, size)
+        if result is None:
+            # the service has no avatar, fall back to the built-in one
+            return
+
+        content, content_type, validator = result
+        headers = [
+            ('ETag', '"{}"'.format(avatar_slug(u'proxy:{}:{}:{}'.format(
+                    email_hash, size, validator)))),
+            ('Cache-Control', 'max-age={}'.format(self.cache_max_age)),
+        ]
+        self._check_modified(req, headers[0][1], None, headers)
+        self._send_avatar(req, content, content_type, headers)
+
+    # Sprite sheets
+
+    # Most avatars on a sprite sheet, sheets are rendered on request.
+    MAX_SPRITE_AVATARS = 256
+
+    def sprite_path(self, hashes, size):
+        """Return the path of the sprite sheet of the avatars of `hashes`
+        relative to the avatar URL, and the offset of every hash in it,
+        or `(None, {})` when there are too many avatars.
+
+        The member hashes are part of the URL, so the sheet can always be
+        rendered again from the request.  The key covers the version of
+        every avatar, so a sheet never changes once generated.
+        """
+        hashes = sorted(set(hashes))
+        if len(hashes) > self.MAX_SPRITE_AVATARS:
+            return None, {}
+        columns = self._sprite_columns(len(hashes))
+        offsets = dict((h, ((i % columns) * size, (i // columns) * size))
+                       for i, h in enumerate(hashes))
+        path = 'sprite/{}?s={}&h={}'.format(self._sprite_key(hashes, size),
+                                            size, '.'.join(hashes))
+        return path, offsets
+
+    def _sprite_key(self, hashes, size):
+        return avatar_slug(u'{}:{}'.format(size, ','.join(
+                u'{}:{}'.format(h, self.avatar_version(h)) for h in hashes)))
+
+    def _sprite_columns(self, count):
+        return max(1, int(math.ceil(math.sqrt(count))))
+
+    def _process_sprite(self, req, key, size):
+        m = re.search(r'(?:^|&)h=(?P<hashes>\w+(?:\.\w+)*)', req.query_string)
+        if not m:
+            raise HTTPNotFound(_('Unknown avatar sprite'))
+        hashes = sorted(set(m.group('hashes').split('.')))
+        if len(hashes) > self.MAX_SPRITE_AVATARS:
+            raise HTTPNotFound(_('Unknown avatar sprite'))
+
+        current = self._sprite_key(hashes, size)
+        if key == current:
+            cache_control = 'max-age={}, immutable'.format(
+                    self.IMMUTABLE_MAX_AGE)
+        else:
+            # an avatar has changed since the page was rendered
+            cache_control = 'max-age={}'.format(self.cache_max_age)
+        headers = [
+            ('ETag', '"{}-{}"'.format(current, size)),
+            ('Cache-Control', cache_control),
+        ]
+        self._check_modified(req, headers[0][1], None, headers)
+
+        content = self.sprite_cache.read(current, 'sprite', size)
+        if content is None:
+            content = self.renders.do(('sprite', current, size),
+                                      self._render_sprite, current, hashes,
+                                      size)
+        self._send_avatar(req, content, 'image/png', headers)
+
+    def _render_sprite(self, key, hashes, size):
+        images = []
+        for email_hash in hashes:
+            entry = self.lookup_hash(email_hash)
+            images.append(self._get_avatar(email_hash, entry,
+                                           self._variant(entry), size))
+        content = compose_sprite(images, size,
+                                 self._sprite_columns(len(hashes)))
+        self.sprite_cache.store(key, 'sprite', size, content)
+        return content
+
+    # Size ladder
+
+    def _get_ladder_sizes(self):
+        """Sizes pre-generated on upload: the avatar sizes smaller than
+        the master picture."""
+        return [size for size in self.get_avatar_sizes()
+                if size < self.AVATAR_SIZE]
+
+    def get_avatar_sizes(self):
+        """Every configured avatar size and its variants for high
+        density displays."""
+        max_density = max(1, self.config.getint('avatar', 'max_density',
+                                                AvatarBackend.max_density.default))
+        sizes = set()
+        for option in AvatarModule.__dict__.itervalues():
+            if not isinstance(option, Option) or \
+                    not option.name.endswith('_size'):
+                continue
+            try:
+                size = int(self.config.get(option.section, option.name,
+                                           option.default))
+            except ValueError:
+                continue
+            for density in xrange(1, max_density + 1):
+                if size > 0:
+                    sizes.add(size * density)
+        return sorted(sizes)
+
+    def _ladder_path(self, filepath, size):
+        return u'{}.{}.png'.format(filepath, size)
+
+    def _save_ladder(self, pa, filepath):
+        """Save every ladder size of the picture, each one resampled from
+        the master so that the errors don't add up."""
+        self._remove_ladder(filepath)
+        for size in self.ladder_sizes:
+            pa.resized(size, size).save_to_png(
+                    self._ladder_path(filepath, size))
+
+    def _remove_ladder(self, filepath):
+        dirname, basename = os.path.split(filepath)
+        pattern = re.compile(re.escape(basename) + r'\.\d+\.png$')
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            return
+        for filename in filenames:
+            if pattern.match(filename):
+                try:
+                    os.remove(os.path.join(dirname, filename))
+                except OSError:
+                    pass
+
+    def _ladder_file(self, filepath, size):
+        """Return the pre-generated picture of exactly `size`, the master
+        picture when `size` isn't smaller than it, or `None`.
+
+        Other sizes, and the ladder of pictures uploaded before the size
+        was configured, are rendered from the master into the render
+        cache instead.
+        """
+        if size >= self.AVATAR_SIZE:
+            path = filepath
+        elif size in self.ladder_sizes:
+            path = self._ladder_path(filepath, size)
+        else:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def _read_ladder(self, filepath, size):
+        path = self._ladder_file(filepath, size)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if req.method == 'POST' and req.path_info.startswith('/prefs') \
+           and 'email' in req.args \
+           and req.args.get('email') != req.session.get('email'):
+            # The general preference panel is about to change the email
+            # address, so the hash index has to be rebuilt.
+            _after_session_save(req, self._email_changed, req.authname,
+                                req.session.get('email'),
+                                req.args.get('email'))
+        return handler
+
+    def _email_changed(self, sid, old_email, new_email):
+        self.invalidate_avatar(sid, old_email)
+        self.invalidate_avatar(sid, new_email)
+        self.invalidate_index()
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Hash index
+
+    @cached
+    def _hash_index(self):
+        """Map every accepted avatar hash to `(sid, filepath, mtime,
+        digest)`.
+
+        A user can be addressed by the sid, the email address or the md5
+        hash of either of them, so all four are registered as keys.
+        """
+        emails = {}
+        avatars = {}
+        for sid, name, value in self.env.db_query("""
+                SELECT sid, name, value FROM session_attribute
+                WHERE name IN ('email', 'avatar')
+                """):
+            if name == 'email':
+                emails[sid] = value
+            else:
+                avatars[sid] = value
+
+        index = {}
+        for sid, email in emails.iteritems():
+            filepath = avatars.get(sid)
+            mtime = digest = None
+            if filepath:
+                try:
+                    mtime = int(os.stat(filepath).st_mtime)
+                    digest = self._read_digest(filepath)
+                except (IOError, OSError):
+                    filepath = mtime = None
+            else:
+                filepath = None
+            entry = (sid, filepath, mtime, digest)
+            for key in (sid, email, avatar_slug(sid), avatar_slug(email)):
+                if key:
+                    index.setdefault(key, entry)
+        return index
+
+    def lookup_hash(self, email_hash):
+        """Return `(sid, filepath, mtime, digest)` for the hash, or
+        `None`."""
+        if not email_hash:
+            return None
+        # Checked first, as the first use of the cached index in a
+        # request queries the cache generation from the database.
+        if self.unknown_hashes.get(email_hash):
+            return None
+        entry = self._hash_index.get(email_hash)
+        if entry is None:
+            self.unknown_hashes.set(email_hash, True)
+        return entry
+
+    def avatar_version(self, email_hash):
+        """Return a token which changes whenever the avatar does."""
+        return self._version(self.lookup_hash(email_hash))
+
+    def _version(self, entry):
+        if entry is None:
+            return '0'
+        sid, filepath, mtime, digest = entry
+        if digest is not None:
+            return digest[:8]
+        return avatar_slug(u'{}:{}'.format(sid,
+                                           self._render_fingerprint()))[:8]
+
+    def _digest_path(self, filepath):
+        return u'{}.digest'.format(filepath)
+
+    def _save_digest(self, filepath):
+        """Store the digest of the content of the picture next to it."""
+        with open(filepath, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        dirname = os.path.dirname(filepath)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(digest)
+        os.rename(tmppath, self._digest_path(filepath))
+
+    def _read_digest(self, filepath):
+        try:
+            with open(self._digest_path(filepath)) as f:
+                return f.read().strip()
+        except IOError:
+            # uploaded before digests were stored
+            with open(filepath, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+
+    def invalidate_index(self):
+        del self._hash_index
+        self.unknown_hashes.clear()
+
+    def invalidate_avatar(self, sid, email=None):
+        """Drop the cached renditions of every hash addressing the user."""
+        for key in set((sid, email, avatar_slug(sid), avatar_slug(email))):
+            if key and re.match(r'\w+$', key):
+                self.render_cache.invalidate(key)
+
+    # Upload
+
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+
+    def _receive_upload(self, fileobj, dirname):
+        """Copy the uploaded file to a temporary file in `dirname` and
+        return its path.
+
+        The upload has already been spooled by `cgi`, so its size is
+        checked against `max_upload_size` before anything is copied.
+        """
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        if size == 0:
+            raise TracError(_('Can\'t upload empty file'))
+        if self.max_upload_size and size > self.max_upload_size:
+            raise TracError(_('Avatar file is too large, the maximum is '
+                              '%(size)s bytes', size=self.max_upload_size))
+        fileobj.seek(0)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, self.UPLOAD_CHUNK_SIZE)
+        except:
+            os.remove(tmppath)
+            raise
+        return tmppath
 
     # IPreferencePanelProvider methods
 
@@ -583,6 +1348,9 @@ class AvatarProvider(Component):
             if 'user_profile_avatar_initialize' in req.args:
                 if 'avatar' in req.session:
                     del req.session['avatar']
+                    req.session.save()
+                    self.invalidate_avatar(author, req.session.get('email'))
+                    self.invalidate_index()
 
                 req.redirect(req.href.prefs(panel or None))
                 return
@@ -591,35 +1359,37 @@ class AvatarProvider(Component):
                 upload = req.args.get('user_profile_avatar', None)
                 if upload is None or not hasattr(upload, 'filename') or not upload.filename:
                     raise TracError(_('No file uploaded'))
-                
-                if hasattr(upload.file, 'fileno'):
-                    size = os.fstat(upload.file.fileno())[6]
-                else:
-                    upload.file.seek(0, 2) # seek to end of file
-                    size = upload.file.tell()
-                    upload.file.seek(0)
-                if size == 0:
-                    raise TracError(_('Can\'t upload empty file'))
-
-                filename = upload.filename
-                filename = filename.replace('\\', '/')
-                filename = os.path.basename(filename)
-
-                try:
-                    pa = PictureAvatar(filename, upload.file)
-                except:
-                    raise TracError(_('Can\'t upload non image file'))
 
                 avatar_dir = os.path.join(os.path.normpath(self.env.path), 'files', 'avatars')
                 if not os.access(avatar_dir, os.F_OK):
                     os.makedirs(avatar_dir)
                 filepath = u'{}/{}'.format(avatar_dir, author)
 
-                req.session['avatar'] = filepath
-
-                if pa.width > self.AVATAR_SIZE or pa.height > self.AVATAR_SIZE:
-                    pa.resize(self.AVATAR_SIZE, self.AVATAR_SIZE)
-                pa.save_to_png(filepath)
+                tmppath = self._receive_upload(upload.file, avatar_dir)
+                try:
+                    try:
+                        pa = PictureAvatar(tmppath,
+                                           max_pixels=self.max_upload_pixels,
+                                           draft_size=self.AVATAR_SIZE)
+                    except ImageTooLarge:
+                        raise TracError(_('Avatar picture is too large, '
+                                          'the maximum is %(pixels)s pixels',
+                                          pixels=self.max_upload_pixels))
+                    except:
+                        raise TracError(_('Can\'t upload non image file'))
+
+                    req.session['avatar'] = filepath
+
+                    if pa.width > self.AVATAR_SIZE or pa.height > self.AVATAR_SIZE:
+                        pa.resize(self.AVATAR_SIZE, self.AVATAR_SIZE)
+                    pa.save_to_png(filepath)
+                    self._save_digest(filepath)
+                    self._save_ladder(pa, filepath)
+                finally:
+                    os.remove(tmppath)
+                req.session.save()
+                self.invalidate_avatar(author, req.session.get('email'))
+                self.invalidate_index()
                 self.env.log.info('New avatar uploaded by {}'.format(author))
 
             req.redirect(req.href.prefs(panel or None))
@@ -627,6 +1397,7 @@ class AvatarProvider(Component):
         return 'prefs_avatar.html', {
             '_': _,
             'user': {
-                'avatar_href': '{}/avatar/{}'.format(self.env.href(), author),
+                'avatar_href': '{}/avatar/{}?v={}'.format(
+                        self.env.href(), author, self.avatar_version(author)),
             },
         }
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Compare the stacked genshi Transformers formerly used by
+# AvatarModule.filter_stream with the single pass StreamRewriter.
+#
+# usage: python benchmarks/bench_filter.py [rows ...]
+
+import os
+import sys
+import time
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from genshi.builder import tag
+from genshi.core import Stream
+from genshi.filters.transform import Transformer
+from genshi.input import HTML
+
+from avatar.rewriter import StreamRule, StreamRewriter
+
+METANAV = '//*/div[@id="metanav"]/ul/li[@class="first"]'
+ATTACHMENTS = '//div[@id="attachments"]/div/ul/li/span[@class="trac-author-user" or @class="trac-author"]' \
+              '|//div[@id="attachments"]/div[@class="attachments"]/dl[@class="attachments"]/dt/span[@class="trac-author-user" or @class="trac-author"]'
+
+def avatar(author):
+    return tag.img(src='/avatar/' + author, class_='avatar', width=20,
+                   height=20).generate()
+
+def text_filter(stream):
+    author = ''.join(part[1] for part in stream if part[0] == 'TEXT').strip()
+    return itertools.chain([stream[0]], avatar(author), stream[1:])
+
+def ticket_page(rows):
+    changes = ''.join('<div class="change"><h3 class="change">'
+                      '<span class="trac-author">user{0}</span></h3>'
+                      '<div class="comment"><p>Comment {0}</p></div></div>'
+                      .format(i) for i in xrange(rows))
+    attachments = ''.join('<dt><a href="#">file{0}</a> added by '
+                          '<span class="trac-author">user{0}</span></dt>'
+                          .format(i) for i in xrange(rows // 10))
+    return HTML(u"""<html><body>
+<div id="metanav"><ul><li class="first">logged in</li><li>Logout</li></ul></div>
+<div id="content"><div id="ticket"><table class="properties"><tr>
+<td headers="h_owner">owner</td></tr></table></div>
+<div id="attachments"><div class="attachments"><dl class="attachments">{}</dl></div></div>
+<div id="changelog">{}</div></div></body></html>""".format(attachments, changes))
+
+def ticket_rules(cls):
+    authors = ['user%d' % i for i in xrange(10000)]
+    def comment(stream):
+        stream = iter(stream)
+        return itertools.chain([next(stream)], avatar(authors.pop()), stream)
+    return [
+        cls(METANAV).prepend(avatar('me')),
+        cls('//div[@id="ticket"]').prepend(avatar('reporter')),
+        cls('//td[@headers="h_owner"]').prepend(avatar('owner')),
+        cls('//div[@id="changelog"]/div[@class="change"]/h3[@class="change"]').filter(comment),
+        cls(ATTACHMENTS).filter(text_filter),
+    ]
+
+def report_page(rows):
+    body = ''.join('<tr><td class="id">#{0}</td><td class="summary">Ticket {0}</td>'
+                   '<td class="owner">user{0}</td><td class="reporter">user{1}</td></tr>'
+                   .format(i, i + 1) for i in xrange(rows))
+    return HTML(u"""<html><body>
+<div id="metanav"><ul><li class="first">logged in</li><li>Logout</li></ul></div>
+<div id="content"><table class="listing tickets"><tbody>{}</tbody></table></div>
+</body></html>""".format(body))
+
+def report_rules(cls):
+    xpath = '//table[@class="listing tickets"]/tbody/tr/td[@class="owner"]' \
+            '|//table[@class="listing tickets"]/tbody/tr/td[@class="reporter"]'
+    return [
+        cls(METANAV).prepend(avatar('me')),
+        cls(xpath).filter(text_filter),
+        cls(ATTACHMENTS).filter(text_filter),
+    ]
+
+def stacked(events, rules):
+    stream = Stream(events)
+    for f in rules(Transformer):
+        stream |= f
+    return stream
+
+def single_pass(events, rules):
+    return Stream(events) | StreamRewriter(rules(StreamRule))
+
+def measure(apply_, events, rules, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        output = apply_(events, rules).render('xhtml')
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+def run(sizes):
+    results = []
+    for page, make_page, rules in (('ticket', ticket_page, ticket_rules),
+                                   ('report', report_page, report_rules)):
+        for rows in sizes:
+            events = list(make_page(rows))
+            old, old_output = measure(stacked, events, rules)
+            new, new_output = measure(single_pass, events, rules)
+            results.append({
+                'name': 'filter_stream.{}'.format(page),
+                'rows': rows,
+                'transformers': old,
+                'rewriter': new,
+                'speedup': old / new if new else None,
+                'identical': old_output == new_output,
+            })
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [50, 500]
+    for result in run(sizes):
+        print '{name:24} rows={rows:<5} transformers={transformers:.4f}s ' \
+              'rewriter={rewriter:.4f}s speedup={speedup:.2f}x ' \
+              'identical={identical}'.format(**result)
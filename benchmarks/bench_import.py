@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# Measure the cost the plugin adds to the start of a Trac process:
+# importing its modules and initializing its components, each in a
+# fresh interpreter with Trac and Genshi already loaded.
+#
+# Pass several checkouts of the plugin to compare them, e.g. the import
+# cost before and after the lazy loading of Pillow, cairosvg and
+# colorhash:
+#
+#   git worktree add /tmp/avatar-old <revision>
+#   python benchmarks/bench_import.py . /tmp/avatar-old
+#
+# usage: python benchmarks/bench_import.py [tree ...]
+
+import os
+import sys
+import json
+import subprocess
+
+REPEAT = 7
+
+CHILD = r"""
+import sys
+import json
+import time
+
+sys.path.insert(0, sys.argv[1])
+import genshi.builder, genshi.filters.transform
+import trac.core, trac.web.api, trac.web.chrome, trac.prefs
+from trac.test import EnvironmentStub
+
+start = time.time()
+import avatar.web_ui
+imported = time.time() - start
+
+env = EnvironmentStub(enable=['trac.*', 'avatar.*'])
+start = time.time()
+avatar.web_ui.AvatarModule(env)
+avatar.web_ui.AvatarProvider(env)
+initialized = time.time() - start
+
+print json.dumps({
+    'import': imported,
+    'init': initialized,
+    'loaded': [name for name in ('PIL.Image', 'cairosvg', 'colorhash')
+               if name in sys.modules],
+})
+"""
+
+def measure(tree):
+    samples = []
+    for i in xrange(REPEAT):
+        output = subprocess.check_output([sys.executable, '-c', CHILD,
+                                          os.path.abspath(tree)])
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    median = lambda values: sorted(values)[len(values) // 2]
+    return {
+        'name': 'startup',
+        'tree': tree,
+        'import': median([s['import'] for s in samples]),
+        'init': median([s['init'] for s in samples]),
+        'loaded': samples[-1]['loaded'],
+    }
+
+def run(trees=None):
+    trees = trees or [os.path.join(os.path.dirname(__file__), os.pardir)]
+    return [measure(tree) for tree in trees]
+
+if __name__ == '__main__':
+    for result in run(sys.argv[1:]):
+        print '{name} {tree}: import={import:.4f}s init={init:.4f}s ' \
+              'loaded={loaded}'.format(**dict(result,
+                  loaded=', '.join(result['loaded']) or 'none'))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Measure AvatarModule.filter_stream, including the author lookup, on
+# synthetic ticket, timeline and report pages.
+#
+# usage: python benchmarks/bench_pages.py [rows ...]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from genshi.core import Stream
+from trac.test import MockRequest
+
+from avatar.web_ui import AvatarModule
+from _env import create_env
+from bench_filter import report_page, ticket_page
+from stress_threads import timeline_page
+
+class Ticket(object):
+
+    def __init__(self, values):
+        self.values = values
+
+def ticket_data(rows):
+    return {
+        'ticket': Ticket({'reporter': 'user1', 'owner': 'user2'}),
+        'changes': [{'author': 'user%d' % i} for i in xrange(rows)],
+    }
+
+def timeline_data(rows):
+    return {'events': [{'author': 'user%d' % i} for i in xrange(rows)]}
+
+def report_data(rows):
+    return {'tickets': [{'owner': 'user%d' % i, 'reporter': 'user%d' % (i + 1)}
+                        for i in xrange(rows)]}
+
+PAGES = [
+    ('ticket', '/ticket/1', 'ticket.html', ticket_page, ticket_data),
+    ('timeline', '/timeline', 'timeline.html', timeline_page, timeline_data),
+    ('report', '/query', 'query.html', report_page, report_data),
+]
+
+def measure(module, env, path_info, template, events, data, repeat):
+    best = None
+    for i in xrange(repeat):
+        req = MockRequest(env, path_info=path_info, authname='user0')
+        req.session['email'] = 'user0@example.org'
+        start = time.time()
+        module.filter_stream(req, 'GET', template, Stream(events),
+                             data).render('xhtml')
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(sizes, backends=('built-in', 'gravatar'), repeat=5):
+    results = []
+    path = tempfile.mkdtemp()
+    env = create_env(max(sizes) + 2, path, renderer='pillow')
+    try:
+        for backend in backends:
+            env.config.set('avatar', 'backend', backend)
+            module = AvatarModule(env)
+            for page, path_info, template, make_page, make_data in PAGES:
+                for rows in sizes:
+                    events = list(make_page(range(rows) if page == 'timeline'
+                                            else rows))
+                    results.append({
+                        'name': 'filter_stream.{}'.format(page),
+                        'backend': backend,
+                        'rows': rows,
+                        'seconds': measure(module, env, path_info, template,
+                                           events, make_data(rows), repeat),
+                    })
+    finally:
+        env.reset_db()
+        shutil.rmtree(path)
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 500]
+    for result in run(sizes):
+        print '{name:24} {backend:10} rows={rows:<5} {seconds:.4f}s' \
+              .format(**result)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Measure the avatar renderers: resizing and encoding an uploaded
+# picture, and rasterising the initial and silhouette avatars at every
+# configured size.
+#
+# usage: python benchmarks/bench_render.py [renderer ...]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from PIL import Image
+from trac.test import EnvironmentStub
+
+from avatar import image
+from avatar.image import InitialAvatar, PictureAvatar, SilhouetteAvatar
+from avatar.web_ui import AvatarProvider
+
+PICTURES = [(640, 480), (4000, 3000)]
+
+def configured_sizes():
+    env = EnvironmentStub(enable=['trac.*', 'avatar.*'])
+    return AvatarProvider(env).get_avatar_sizes()
+
+def best_of(function, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_pictures(tmpdir, sizes, repeat):
+    results = []
+    for width, height in PICTURES:
+        for fmt in ('JPEG', 'PNG'):
+            path = os.path.join(tmpdir, 'upload.{}'.format(fmt.lower()))
+            Image.new('RGB', (width, height), 'teal').save(path, fmt)
+            master = os.path.join(tmpdir, 'master')
+
+            def upload():
+                pa = PictureAvatar(path, draft_size=AvatarProvider.AVATAR_SIZE)
+                pa.resize(AvatarProvider.AVATAR_SIZE, AvatarProvider.AVATAR_SIZE)
+                pa.save_to_png(master)
+                for size in reversed(sizes):
+                    if size < AvatarProvider.AVATAR_SIZE:
+                        pa.resize(size, size)
+                        pa.get_png()
+
+            results.append({
+                'name': 'picture.upload',
+                'format': fmt.lower(),
+                'pixels': '{}x{}'.format(width, height),
+                'seconds': best_of(upload, repeat),
+            })
+    return results
+
+def bench_generated(renderers, sizes, repeat):
+    results = []
+    for renderer in renderers:
+        if image.get_renderer(renderer) != renderer:
+            # it would silently measure the fallback
+            results.append({
+                'name': 'render',
+                'renderer': renderer,
+                'seconds': None,
+                'error': '{} is not available, it falls back to {}'.format(
+                         renderer, image.get_renderer(renderer)),
+            })
+            continue
+        for cls in (InitialAvatar, SilhouetteAvatar):
+            for size in sizes:
+                def render():
+                    # get_png() is memoized per process
+                    image._png_cache.clear()
+                    avatar = cls('user', size, size)
+                    avatar.set_renderer(renderer)
+                    avatar.get_png()
+                try:
+                    seconds = best_of(render, repeat)
+                    error = None
+                except Exception, e:
+                    seconds = None
+                    error = '{}: {}'.format(e.__class__.__name__, e)
+                results.append({
+                    'name': '{}.render'.format(cls.__name__),
+                    'renderer': renderer,
+                    'size': size,
+                    'seconds': seconds,
+                    'error': error,
+                })
+    return results
+
+def run(renderers=('pillow', 'cairosvg'), repeat=5):
+    sizes = configured_sizes()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        return bench_pictures(tmpdir, sizes, repeat) + \
+               bench_generated(renderers, sizes, repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    renderers = sys.argv[1:] or ['pillow', 'cairosvg']
+    for result in run(renderers):
+        if result.get('error'):
+            print '{name} {renderer} failed: {error}'.format(**result)
+        elif 'pixels' in result:
+            print '{name} {format} {pixels} {seconds:.4f}s'.format(**result)
+        else:
+            print '{name} {renderer} size={size} {seconds:.5f}s' \
+                  .format(**result)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Measure AvatarProvider.process_request against an in-memory Trac
+# environment with N users: cold renders, render cache hits,
+# conditional requests answered with 304 and hashes without a user.
+#
+# usage: python benchmarks/bench_request.py [users ...]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from trac.test import MockRequest
+from trac.web.api import RequestDone
+
+from avatar import image
+from avatar.backend import avatar_slug
+from avatar.web_ui import AvatarProvider
+from _env import create_env
+
+SIZE = 24
+
+def request(provider, env, email_hash, etag=None):
+    """Return the status and the ETag of the response."""
+    response = {}
+    req = MockRequest(env, path_info=str('/avatar/' + email_hash))
+    req.environ['QUERY_STRING'] = 's={}'.format(SIZE)
+    req.get_header = lambda name: etag if name == 'If-None-Match' else None
+    req.send_response = lambda code: response.__setitem__('status', code)
+    req.send_header = lambda name, value: response.__setitem__(name, value)
+    req.end_headers = lambda: None
+    req.write = lambda data: None
+    try:
+        provider.process_request(req)
+    except RequestDone:
+        pass
+    if getattr(req, '_response', None) is not None:
+        # a cached avatar streamed from disk
+        for block in req._response:
+            pass
+        req._response.close()
+    return response.get('status'), response.get('ETag')
+
+def measure(provider, env, hashes, etags=None):
+    start = time.time()
+    for email_hash in hashes:
+        request(provider, env, email_hash, etags and etags[email_hash])
+    elapsed = time.time() - start
+    return {
+        'requests': len(hashes),
+        'seconds': elapsed,
+        'requests_per_second': len(hashes) / elapsed if elapsed else None,
+    }
+
+def run(sizes):
+    results = []
+    for users in sizes:
+        path = tempfile.mkdtemp()
+        env = create_env(users, path, renderer='pillow')
+        try:
+            provider = AvatarProvider(env)
+            hashes = [avatar_slug('user%d@example.org' % i)
+                      for i in xrange(users)]
+            image._png_cache.clear()
+            cold = measure(provider, env, hashes)
+            warm = measure(provider, env, hashes)
+            etags = dict((h, request(provider, env, h)[1]) for h in hashes)
+            conditional = measure(provider, env, hashes, etags)
+            unknown = ['%032x' % i for i in xrange(users)]
+            measure(provider, env, unknown)
+            unknown = measure(provider, env, unknown)
+            for phase, result in (('cold', cold), ('cached', warm),
+                                  ('not_modified', conditional),
+                                  ('unknown', unknown)):
+                result.update(name='process_request.{}'.format(phase),
+                              users=users)
+                results.append(result)
+        finally:
+            env.reset_db()
+            shutil.rmtree(path)
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000]
+    for result in run(sizes):
+        print '{name:28} users={users:<5} {requests_per_second:.1f} ' \
+              'requests/s'.format(**result)
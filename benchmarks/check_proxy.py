@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# Check the caching of AvatarProxy against a local stub of the upstream
+# avatar service: first fetch, fresh cache hit, revalidation answered
+# with 304, refetch of an evicted image, negative caching of a 404 and
+# the stale copy served while the upstream fails or is down.
+#
+# usage: python benchmarks/check_proxy.py
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from avatar.cache import RenderCache
+from avatar.proxy import AvatarProxy
+
+IMAGE = 'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!' \
+        '\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00' \
+        '\x00\x02\x02D\x01\x00;'
+ETAG = '"upstream-1"'
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path,
+                                     self.headers.get('If-None-Match')))
+        if 'missing' in self.path:
+            self.send_response(404)
+            self.end_headers()
+        elif self.server.failing:
+            self.send_response(500)
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/gif')
+            self.send_header('Content-Length', len(IMAGE))
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            self.wfile.write(IMAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.failing = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def expire(proxy, email_hash, size):
+    meta = proxy._read_meta(email_hash, size)
+    meta['expires'] = 0
+    proxy._write_meta(email_hash, size, meta)
+
+def run():
+    tmpdir = tempfile.mkdtemp()
+    server = start_stub()
+    base = 'http://127.0.0.1:{}/avatar/'.format(server.server_port)
+    proxy = AvatarProxy(RenderCache(tmpdir, 1024 * 1024), ttl=3600,
+                        negative_ttl=3600, timeout=2)
+    results = []
+
+    def check(name, passed):
+        results.append({
+            'name': 'proxy.{}'.format(name),
+            'passed': bool(passed),
+            'upstream_requests': len(server.requests),
+        })
+
+    try:
+        url = base + 'abc?s=32'
+        result = proxy.get(url, 'abc', 32)
+        check('first_fetch', result is not None and
+                             result[:2] == (IMAGE, 'image/gif') and
+                             len(server.requests) == 1 and
+                             proxy.cache.read('abc', 'proxy', 32, 'img')
+                                 == IMAGE)
+
+        count = len(server.requests)
+        result = proxy.get(url, 'abc', 32)
+        check('ttl_hit', result is not None and result[0] == IMAGE and
+                         len(server.requests) == count)
+
+        expire(proxy, 'abc', 32)
+        result = proxy.get(url, 'abc', 32)
+        check('revalidate_304', result is not None and
+                                result[0] == IMAGE and
+                                server.requests[-1] == ('/avatar/abc?s=32',
+                                                        ETAG) and
+                                proxy._read_meta('abc', 32)['expires']
+                                    > time.time())
+
+        expire(proxy, 'abc', 32)
+        os.remove(proxy.cache.path('abc', 'proxy', 32, 'img'))
+        result = proxy.get(url, 'abc', 32)
+        check('refetch_evicted', result is not None and
+                                 result[0] == IMAGE and
+                                 server.requests[-1] == ('/avatar/abc?s=32',
+                                                         None))
+
+        server.failing = True
+        expire(proxy, 'abc', 32)
+        result = proxy.get(url, 'abc', 32)
+        count = len(server.requests)
+        again = proxy.get(url, 'abc', 32)
+        check('stale_on_500', result is not None and result[0] == IMAGE and
+                              again is not None and
+                              len(server.requests) == count and
+                              proxy._read_meta('abc', 32)['etag'] == ETAG)
+        server.failing = False
+
+        url = base + 'missing?s=32'
+        first = proxy.get(url, 'missing', 32)
+        count = len(server.requests)
+        second = proxy.get(url, 'missing', 32)
+        check('negative_404', first is None and second is None and
+                              len(server.requests) == count)
+
+        server.shutdown()
+        server.server_close()
+        expire(proxy, 'abc', 32)
+        result = proxy.get(base + 'abc?s=32', 'abc', 32)
+        check('stale_when_down', result is not None and result[0] == IMAGE)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+if __name__ == '__main__':
+    results = run()
+    for result in results:
+        print '{name:24} {0} upstream_requests={upstream_requests}'.format(
+              'ok' if result['passed'] else 'FAILED', **result)
+    sys.exit(0 if all(r['passed'] for r in results) else 1)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Run the avatar benchmarks and write their results as JSON, so that
+# runs of different versions can be compared.
+#
+# usage: python benchmarks/run.py [-o results.json] [-c baseline.json]
+#                                 [--quick] [benchmark ...]
+#
+# With -c, the seconds of every result are compared with the matching
+# result of an earlier run and the ratios are printed.  The exit status
+# is 1 when a correctness check failed, e.g. stress_threads found pages
+# with wrong avatars.
+
+import os
+import re
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_filter
+import bench_import
+import bench_lookup
+import bench_pages
+import bench_render
+import bench_request
+import check_proxy
+import stress_threads
+
+BENCHMARKS = [
+    ('import', lambda quick: bench_import.run()),
+    ('render', lambda quick: bench_render.run(repeat=2 if quick else 5)),
+    ('request', lambda quick: bench_request.run([20] if quick else [100, 1000])),
+    ('pages', lambda quick: bench_pages.run([50] if quick else [100, 500])),
+    ('filter', lambda quick: bench_filter.run([50] if quick else [50, 500])),
+    ('lookup', lambda quick: bench_lookup.run([100] if quick else [10, 1000, 10000])),
+    ('proxy', lambda quick: check_proxy.run()),
+    ('threads', lambda quick: stress_threads.run(40 if quick else 400,
+                                                 [1, 4] if quick else [1, 2, 4, 8])),
+]
+
+def plugin_version():
+    setup_py = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'setup.py')
+    try:
+        with open(setup_py) as f:
+            match = re.search(r"^version = '([^']+)'", f.read(), re.M)
+    except IOError:
+        return None
+    return match.group(1) if match else None
+
+def result_key(result):
+    return tuple(sorted((k, v) for k, v in result.iteritems()
+                        if isinstance(v, (basestring, int)) and
+                           not isinstance(v, bool) and
+                           k not in ('requests', 'pages', 'wrong_pages')))
+
+def compare(results, baseline):
+    previous = dict((result_key(r), r) for r in baseline['results'])
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old or not old.get('seconds') or not result.get('seconds'):
+            continue
+        label = ' '.join('{}={}'.format(k, v) for k, v in result_key(result)
+                         if k != 'name')
+        print >> sys.stderr, '{:28} {:40} {:.2f}x'.format(
+                result['name'], label, result['seconds'] / old['seconds'])
+
+def main(args):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-o', '--output', help='write the results to FILE '
+                                             'instead of stdout')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare with the results of an earlier run')
+    parser.add_option('--quick', action='store_true',
+                      help='fewer rows and repetitions')
+    options, names = parser.parse_args(args)
+    known = [name for name, function in BENCHMARKS]
+    for name in names:
+        if name not in known:
+            parser.error('unknown benchmark {}, choose from {}'
+                         .format(name, ', '.join(known)))
+
+    results = []
+    for name, function in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print >> sys.stderr, 'running {}...'.format(name)
+        for result in function(options.quick):
+            result['benchmark'] = name
+            results.append(result)
+
+    # correctness checks riding along with the timings
+    failures = [result for result in results
+                if result.get('wrong_pages') or result.get('passed') is False]
+    for result in failures:
+        print >> sys.stderr, 'FAILED: {}'.format(json.dumps(result,
+                                                            sort_keys=True))
+    for result in results:
+        if result.get('error'):
+            print >> sys.stderr, 'skipped {name}: {error}'.format(**result)
+
+    output = {
+        'version': plugin_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'quick': bool(options.quick),
+        'failures': len(failures),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
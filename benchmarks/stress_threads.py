@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Render timeline pages through AvatarModule.filter_stream from several
+# threads at once, with the gravatar and the built-in backend, check that
+# every page got the avatars of its own authors and report the throughput
+# per thread count.
+#
+# usage: python benchmarks/stress_threads.py [pages] [threads ...]
+
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from genshi.core import Stream
+from genshi.input import HTML
+from trac.test import MockRequest
+
+from avatar.backend import avatar_slug
+from avatar.web_ui import AvatarModule
+from _env import create_env
+
+USERS = 200
+EVENTS = 50
+
+def timeline_page(events):
+    return list(HTML(u"""<html><body><div id="content"><dl>{}</dl></div>
+</body></html>""".format(''.join(
+        '<dt><a href="#"><span class="time">{}:00</span> event</a></dt>'
+        .format(i) for i in xrange(len(events))))))
+
+def render(module, env, seed):
+    authors = ['user%d' % ((seed * 7 + i) % USERS) for i in xrange(EVENTS)]
+    data = {'events': [{'author': a} for a in authors]}
+    req = MockRequest(env, path_info='/timeline')
+    stream = module.filter_stream(req, 'GET', 'timeline.html',
+                                  Stream(page), data)
+    output = stream.render('xhtml')
+    expected = [avatar_slug('%s@example.org' % a) for a in authors]
+    # only the src of each avatar, srcset repeats the hash per density
+    found = [src.rsplit('/', 1)[-1].split('?')[0]
+             for src in re.findall(r'<img[^>]* src="([^"]*)"', output)]
+    return found == expected
+
+def worker(module, env, seeds, errors):
+    for seed in seeds:
+        if not render(module, env, seed):
+            errors.append(seed)
+
+def run(pages, thread_counts, backends=('gravatar', 'built-in')):
+    env = create_env(USERS, renderer='pillow')
+    results = []
+    try:
+        for backend, threads in itertools.product(backends, thread_counts):
+            env.config.set('avatar', 'backend', backend)
+            module = AvatarModule(env)
+            errors = []
+            seeds = range(pages)
+            workers = [threading.Thread(target=worker,
+                                        args=(module, env,
+                                              seeds[i::threads], errors))
+                       for i in xrange(threads)]
+            start = time.time()
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            elapsed = time.time() - start
+            results.append({
+                'name': 'filter_stream.concurrent',
+                'backend': backend,
+                'threads': threads,
+                'pages': pages,
+                'pages_per_second': pages / elapsed,
+                'wrong_pages': len(errors),
+            })
+    finally:
+        env.reset_db()
+    return results
+
+page = timeline_page(range(EVENTS))
+
+if __name__ == '__main__':
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    thread_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, 8]
+    for result in run(pages, thread_counts):
+        print '{name} backend={backend} threads={threads} pages={pages} ' \
+              '{pages_per_second:.1f} pages/s ' \
+              'wrong_pages={wrong_pages}'.format(**result)
@@ -58,6 +58,7 @@ setup(
     },
     entry_points = {
         'trac.plugins': [
+            'avatar.admin = avatar.admin',
             'avatar.web_ui = avatar.web_ui',
         ]
     }